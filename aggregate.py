@@ -0,0 +1,106 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import array
+import threading
+import time
+import state
+from log import debug, info, warn, error, critical, exception
+
+# Buckets per sensor, one for each hour of the week (Monday 00:00-01:00 local time is 0).
+HOURS = 7 * 24
+WEEK = HOURS * 3600
+
+
+class OccupancyAggregates:
+    ''' Seconds each sensor spent on, and seconds its state was known, per hour of the week.
+    Every transition adds the time since the one before it to the buckets it spans, so a summary
+    costs O(buckets) however long the history is.
+    '''
+
+    def __init__(self):
+        # sensor key -> array of seconds per hour of the week
+        self.on = dict((key, array.array('d', [0.0]) * HOURS) for key in state.SENSORS)
+        self.known = dict((key, array.array('d', [0.0]) * HOURS) for key in state.SENSORS)
+        # The latest transition applied, its state lasts until the next one.
+        self.last_time = None
+        self.last_state = None
+        # Hours changed since the last call to pop_dirty().
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        ''' Forget everything, eg before applying the whole history again '''
+        with self._lock:
+            for buckets in self.on.values() + self.known.values():
+                buckets[:] = array.array('d', [0.0]) * HOURS
+            self.last_time = self.last_state = None
+            self._dirty = set(xrange(HOURS))
+
+    def apply(self, time_observed, packed):
+        ''' Add a transition. Transitions older than the latest one applied are ignored.
+        @param	time_observed	When it was seen in unix seconds.
+        @param	packed		The packed sensor state it changed to.
+        '''
+        with self._lock:
+            if self.last_time is not None:
+                if time_observed < self.last_time:
+                    return
+                self._add(self.last_time, time_observed, self.last_state)
+            self.last_time, self.last_state = time_observed, packed
+
+    def _add(self, start, end, packed):
+        ''' Count the time from start to end as spent in a state '''
+        values = [(key, state.value(packed, key)) for key in state.SENSORS]
+        values = [(key, value) for key, value in values if value is not None]
+        if not values:
+            return
+        # Whole weeks cover every bucket evenly.
+        weeks = int((end - start) // WEEK)
+        if weeks:
+            for key, value in values:
+                for hour in xrange(HOURS):
+                    self.known[key][hour] += weeks * 3600
+                    if value:
+                        self.on[key][hour] += weeks * 3600
+            self._dirty.update(xrange(HOURS))
+            start += weeks * WEEK
+        while start < end:
+            local = time.localtime(start)
+            hour = local.tm_wday * 24 + local.tm_hour
+            # Up to the end of this local hour (or to end if that comes first).
+            into_hour = local.tm_min * 60 + local.tm_sec + (start - int(start))
+            step = min(end - start, 3600 - into_hour)
+            for key, value in values:
+                self.known[key][hour] += step
+                if value:
+                    self.on[key][hour] += step
+            self._dirty.add(hour)
+            start += step
+
+    def ratios(self, key):
+        ''' Return the fraction of the time a sensor was on for each hour of the week.
+        @return		List of HOURS floats, None for hours its state has never been known in.
+        '''
+        with self._lock:
+            return [on / known if known else None for on, known in zip(self.on[key], self.known[key])]
+
+    def load(self, rows, last_time, last_state):
+        ''' Restore saved buckets.
+        @param	rows		Iterable of (sensor key, hour, seconds on, seconds known).
+        @param	last_time	time_observed of the latest transition applied to them.
+        @param	last_state	The packed state of that transition.
+        '''
+        with self._lock:
+            for key, hour, on, known in rows:
+                if key in self.on:
+                    self.on[key][hour] = on
+                    self.known[key][hour] = known
+            self.last_time, self.last_state = last_time, last_state
+
+    def pop_dirty(self):
+        ''' Return the buckets changed since the last call as (sensor key, hour, seconds on, seconds known) rows '''
+        with self._lock:
+            hours, self._dirty = sorted(self._dirty), set()
+            return [(key, hour, self.on[key][hour], self.known[key][hour]) for key in state.SENSORS for hour in hours]
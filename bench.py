@@ -0,0 +1,65 @@
+#!/usr/bin/python
+''' Microbenchmarks for the Status plugin. Run from the plugin directory: python bench.py '''
+
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import logging
+import timeit
+import log
+from update import StatusParser
+
+# A day's worth of sensor uploads, give or take.
+sample_payloads = ['date=%s,_Jan_%02d_at_%02d:%02d_%s\nsubject=Lights=%s\nbody=GPIO4=false;GPIO5=false;FA3=%s;FA4=%s;FA5=false\n' % (
+        day, date, hour, minute, ampm, lights, lights, hall)
+        for day, date in (('Monday', 20), ('Tuesday', 21), ('Wednesday', 22))
+        for hour in range(1, 13)
+        for minute in (0, 17, 45)
+        for ampm in ('AM', 'PM')
+        for lights, hall in (('true', 'false'), ('false', 'true'))]
+
+def parser_throughput(method, payloads=sample_payloads, repeat=3):
+    ''' Return the best rate StatusParser.<method> parsed payloads at.
+    @param	method		Name of the StatusParser parse method to time.
+    @param	payloads	List of sensor upload strings.
+    @param	repeat		Number of runs to take the best of.
+    @return			Payloads per second.
+    '''
+    def run():
+        for payload in payloads:
+            getattr(StatusParser(), method)(payload)
+    return len(payloads) / min(timeit.repeat(run, number=1, repeat=repeat))
+
+def bench_parser():
+    ''' Compare the single pass parser to the original split based one '''
+    split = parser_throughput('parse_status_split')
+    single = parser_throughput('parse_status')
+    print 'parse_status_split: %10.0f payloads/s' % split
+    print 'parse_status:       %10.0f payloads/s (%.1fx)' % (single, single / split)
+
+def logging_overhead(debug_call, number=100000, repeat=3):
+    ''' Return the best time one disabled debug call took.
+    @param	debug_call	Callable taking a status message dict and logging it at DEBUG.
+    @param	number		Calls per run.
+    @param	repeat		Number of runs to take the best of.
+    @return			Seconds per call.
+    '''
+    message = {'default': 'HacDC is closed since 12:17AM Monday 20 Jan', 'raw': sample_payloads[0]}
+    return min(timeit.repeat(lambda: debug_call(message), number=number, repeat=repeat)) / number
+
+def bench_logging():
+    ''' Compare eagerly formatted debug calls with exc_info to the level gated ones, with DEBUG off '''
+    level = log.logger.level
+    log.logger.setLevel(logging.INFO)
+    try:
+        eager = logging_overhead(lambda message: log.logger.debug('message: %s' % str(message), exc_info=True))
+        gated = logging_overhead(lambda message: log.debug('message: %s', message))
+    finally:
+        log.logger.setLevel(level)
+    print 'eager debug(): %8.2f us/call' % (eager * 1e6)
+    print 'gated debug(): %8.2f us/call (%.1fx)' % (gated * 1e6, eager / gated)
+
+if __name__ == '__main__':
+    bench_parser()
+    bench_logging()
@@ -14,22 +14,58 @@ conf.registerGlobalValue(Status, 'use_notice',
     registry.Boolean(False, '''Use notices instead of privmsgs'''))
 
 conf.registerGlobalValue(Status, 'source_url',
-        registry.String('http://api.hacdc.org/OccSensor.txt', '''Source to check for updates.'''))
+        registry.String('http://api.hacdc.org/OccSensor.txt', '''Source to check for updates. Redirects are followed, but proxies (eg the http_proxy environment variable) are not used.'''))
+
+conf.registerGlobalValue(Status, 'change_detection',
+        registry.String('lights', '''What counts as a new status: 'lights' for a change of the overall lights state or 'any' for a change of any sensor.'''))
 
 conf.registerGlobalValue(Status, 'quiet_channels',
                             registry.SpaceSeparatedListOfStrings(' #hacdcbot2 ', '''Channels to not announce changes in.'''))
 
+conf.registerChannelValue(Status, 'sensors',
+        registry.SpaceSeparatedListOfStrings('lights', '''Sensors whose changes are announced in the channel. 'lights' gets the usual status message, the others (gpio4 gpio5 fa3 fa4 fa5) get a line like 'hall light: off -> on'.'''))
+
+conf.registerGlobalValue(Status, 'announce_rate',
+                    registry.PositiveFloat(1.0, '''Average number of status announcements per second sent to each network.'''))
+
+conf.registerGlobalValue(Status, 'announce_burst',
+                    registry.PositiveInteger(5, '''Number of status announcements that can be sent to a network at once before announce_rate applies.'''))
+
 conf.registerGlobalValue(Status, 'debug_channel',
                     registry.String('#hacdcbot', '''Channel to print debug info to.'''))
 
 conf.registerGlobalValue(Status, 'interval',
-                    registry.Integer(3, '''Interval to check remote status in seconds'''))
+                    registry.Integer(3, '''Interval to check remote status in seconds. This is the shortest interval used, right after a change or in hours the status usually changes in.'''))
+
+conf.registerGlobalValue(Status, 'max_interval',
+                    registry.Integer(60, '''Longest interval to check remote status in seconds while the status is not changing.'''))
+
+conf.registerGlobalValue(Status, 'backoff',
+                    registry.Float(1.5, '''Factor the check interval grows by after each check that finds no change.'''))
 
 conf.registerGlobalValue(Status, 'connect_delay',
                     registry.Integer(15, '''Number of seconds to wait before announcing a new status when connecting to the IRC server. This is the number of seconds to wait from startup not after joining channels.'''))
 
+conf.registerGlobalValue(Status, 'settle_window',
+                    registry.Integer(10, '''Number of seconds the status has to stay the same before a change is announced. Changes that flip back within this window are not announced at all.'''))
+
+conf.registerGlobalValue(Status, 'min_dwell',
+                    registry.Integer(60, '''Minimum number of seconds between announcements. Changes in the meantime are collapsed into one announcement of the latest state.'''))
+
+conf.registerGlobalValue(Status, 'max_hold',
+                    registry.Integer(120, '''Maximum number of seconds a change is held back while the status keeps changing. After this the latest status is announced even if it hasn't settled.'''))
+
 conf.registerGlobalValue(Status, 'max_status_age',
-                    registry.Integer(30, '''Maximum age of the cached status in minutes. The status will be fetched before replying to the status command if it is older than this.'''))
+                    registry.Integer(30, '''Maximum age of the cached status in minutes. The status command still answers from the cache right away if it is older than this, but a fresh status is fetched in the background.'''))
+
+conf.registerGlobalValue(Status, 'show_status_age',
+                    registry.Boolean(True, '''Add "(as of N min ago)" to the status command's reply when the cached status is older than max_status_age.'''))
+
+conf.registerGlobalValue(Status, 'history_size',
+                    registry.Integer(1024, '''Number of status changes kept in memory for the status history and since commands. Takes effect on restart.'''))
+
+conf.registerGlobalValue(Status, 'history_db',
+                    registry.String('StatusHistory.db', '''File in the bot's data directory the status history is kept in across restarts. Empty to keep no history on disk. Takes effect on restart.'''))
 
 # state cache
 conf.registerGlobalValue(Status, 'message_default',  registry.String('no status yet', '''Default status message'''))
@@ -37,6 +73,8 @@ conf.registerGlobalValue(Status, 'message_human',  registry.String('no status ye
 conf.registerGlobalValue(Status, 'message_raw',  registry.String('no status yet', '''Status message as it comes from the sensor'''))
 conf.registerGlobalValue(Status, 'time_fetched',
                     registry.Integer(0, '''Unix timestamp of the time of the most recently fetched status'''))
+conf.registerGlobalValue(Status, 'registry_flush_interval',
+                    registry.Integer(60, '''Minimum number of seconds between writes of the status cache to the registry.'''))
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,236 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import errno
+import httplib
+import socket
+import ssl
+import threading
+import time
+import urlparse
+from log import debug, info, warn, error, critical, exception
+
+# Exceptions that mean a reused keep-alive connection went away under us.
+StaleConnectionExceptions = (httplib.BadStatusLine, httplib.CannotSendRequest, httplib.ResponseNotReady, socket.error)
+
+
+class Response:
+    ''' The parts of an http reply the Updater cares about '''
+    def __init__(self, status, headers, body):
+        '''
+        @param	status	The http status code.
+        @param	headers	The mimetools.Message of reply headers.
+        @param	body	The body of the reply as a string.
+        '''
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        ''' Return the value of a reply header or default if it is missing '''
+        return self.headers.getheader(name, default)
+
+
+class AddressCache:
+    ''' Cache resolved addresses so every poll doesn't need a DNS lookup '''
+
+    def __init__(self, ttl=300, clock=time.time):
+        '''
+        @param	ttl	Number of seconds to trust a resolved address.
+        @param	clock	Callable returning the current time in seconds.
+        '''
+        self.ttl = ttl
+        self.clock = clock
+        # (host, port) -> (expires, family, sockaddr)
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        ''' Resolve host and port, using the cached address if it is still fresh.
+        @return		(family, sockaddr) suitable for socket.socket() and socket.connect()
+        '''
+        now = self.clock()
+        with self._lock:
+            cached = self._addresses.get((host, port))
+        if cached and cached[0] > now:
+            return cached[1:]
+        family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        debug('AddressCache.resolve: %s:%s -> %s', host, port, sockaddr)
+        with self._lock:
+            self._addresses[(host, port)] = (now + self.ttl, family, sockaddr)
+        return family, sockaddr
+
+    def forget(self, host, port):
+        ''' Drop the cached address for host and port (eg after it stopped answering) '''
+        with self._lock:
+            self._addresses.pop((host, port), None)
+
+
+class KeepAliveConnection(httplib.HTTPConnection):
+    ''' HTTP/1.1 connection that connects through an AddressCache '''
+
+    def __init__(self, host, port, timeout, resolver):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.resolver = resolver
+        # The socket while it is still connecting, so abort() can reach it.
+        self._connecting = None
+
+    def _open_socket(self):
+        ''' Open a socket to the cached address of this connection's host '''
+        family, sockaddr = self.resolver.resolve(self.host, self.port)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        self._connecting = sock
+        try:
+            sock.connect(sockaddr)
+        except socket.error:
+            sock.close()
+            # The address may have moved, look it up again next time.
+            self.resolver.forget(self.host, self.port)
+            raise
+        finally:
+            self._connecting = None
+        return sock
+
+    def connect(self):
+        self.sock = self._open_socket()
+
+    def abort(self):
+        ''' Shut the socket down under the request in progress, which fails with one of StaleConnectionExceptions.
+        Safe to call from another thread.
+        '''
+        for sock in (self._connecting, self.sock):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class KeepAliveHTTPSConnection(KeepAliveConnection):
+    ''' KeepAliveConnection wrapped in TLS, with SNI and the server's certificate and host name checked '''
+
+    default_port = httplib.HTTPS_PORT
+
+    def __init__(self, host, port, timeout, resolver):
+        KeepAliveConnection.__init__(self, host, port, timeout, resolver)
+        self.context = ssl.create_default_context()
+
+    def connect(self):
+        self.sock = self.context.wrap_socket(self._open_socket(), server_hostname=self.host)
+
+
+class ConnectionPool:
+    ''' Persistent keep-alive connections keyed by (scheme, host, port).
+    Redirects are followed. Proxies (eg the http_proxy environment variable) are not supported,
+    connections always go straight to the host in the url.
+    '''
+
+    connection_classes = {'http': KeepAliveConnection, 'https': KeepAliveHTTPSConnection}
+    redirect_codes = (301, 302, 303, 307, 308)
+    # Most redirects followed for one get().
+    max_redirects = 5
+
+    def __init__(self, timeout=30, dns_ttl=300):
+        '''
+        @param	timeout	Socket timeout in seconds.
+        @param	dns_ttl	Number of seconds to cache resolved addresses.
+        '''
+        self.timeout = timeout
+        self.resolver = AddressCache(dns_ttl)
+        # (scheme, host, port) -> KeepAliveConnection
+        self._connections = {}
+        # A connection can only carry one request at a time.
+        self._lock = threading.Lock()
+        # Set by abort(), no more requests are made after that.
+        self.aborted = False
+
+    def _connection(self, scheme, host, port):
+        ''' Return the pooled connection for a host, creating it if needed '''
+        key = (scheme, host, port)
+        if key not in self._connections:
+            debug('ConnectionPool: new connection to %s://%s:%s', *key)
+            self._connections[key] = self.connection_classes[scheme](host, port, self.timeout, self.resolver)
+        return self._connections[key]
+
+    def _discard(self, conn):
+        ''' Close a connection and drop it from the pool '''
+        conn.close()
+        for key, pooled in self._connections.items():
+            if pooled is conn:
+                del self._connections[key]
+
+    def get(self, url, headers=None):
+        ''' GET url over a pooled connection, following redirects.
+        A connection the server dropped since the last request is reopened once transparently.
+        @param	url	The url to fetch.
+        @param	headers	dict of extra request headers.
+        @return		A Response instance.
+        @raise	httplib.HTTPException	If there are more than max_redirects redirects or the url isn't http or https.
+        '''
+        for hop in xrange(self.max_redirects + 1):
+            reply = self._get(url, headers)
+            location = reply.getheader('location')
+            if reply.status not in self.redirect_codes or not location:
+                return reply
+            url = urlparse.urljoin(url, location)
+            debug('ConnectionPool.get: HTTP %s, redirected to %s', reply.status, url)
+        raise httplib.HTTPException('More than %d redirects' % self.max_redirects)
+
+    def _get(self, url, headers):
+        ''' GET url over a pooled connection without following redirects '''
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        if scheme not in self.connection_classes:
+            # An HTTPException so a redirect somewhere odd is handled like any other failed fetch.
+            raise httplib.InvalidURL('Unsupported url scheme: %s' % scheme)
+        port = parts.port or self.connection_classes[scheme].default_port
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._lock:
+            if self.aborted:
+                raise socket.error(errno.ECONNABORTED, 'Connection pool aborted')
+            conn = self._connection(scheme, parts.hostname, port)
+            # A connection with a socket has been used before and may have gone stale.
+            reused = conn.sock is not None
+            try:
+                return self._request(conn, path, headers)
+            except StaleConnectionExceptions as e:
+                self._discard(conn)
+                if not reused or self.aborted or isinstance(e, socket.timeout):
+                    raise
+                debug('ConnectionPool.get: reconnecting after %r', e)
+                conn = self._connection(scheme, parts.hostname, port)
+                try:
+                    return self._request(conn, path, headers)
+                except StaleConnectionExceptions:
+                    self._discard(conn)
+                    raise
+
+    def _request(self, conn, path, headers):
+        ''' Send a GET on conn and read the whole reply so the connection can be reused '''
+        conn.request('GET', path, headers=headers or {})
+        reply = conn.getresponse()
+        body = reply.read()
+        if reply.will_close:
+            # The server won't keep this one open, start fresh next time.
+            conn.close()
+        return Response(reply.status, reply.msg, body)
+
+    def abort(self):
+        ''' Stop the pool for good, cutting short any request in progress.
+        Unlike close() this doesn't wait for the request in progress, so it can be called from
+        another thread to stop a poller promptly.
+        '''
+        self.aborted = True
+        for conn in self._connections.values():
+            conn.abort()
+
+    def close(self):
+        ''' Close every pooled connection '''
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
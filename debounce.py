@@ -0,0 +1,90 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import state
+from schedule import monotonic
+from log import debug, info, warn, error, critical, exception
+
+
+class Debouncer:
+    ''' Hold announcements back until the status settles.
+    A change is only announced once no further change has come in for settle seconds and at
+    least min_dwell seconds have passed since the last announcement, so a flapping sensor
+    collapses into one announcement of wherever it ended up (or none if it ended up where it
+    started). A status that never settles is still announced max_hold seconds after the first
+    change held back.
+    '''
+
+    def __init__(self, settle=10, min_dwell=60, max_hold=120, clock=monotonic):
+        '''
+        @param	settle		Seconds without a change before a change is announced.
+        @param	min_dwell	Minimum seconds between announcements.
+        @param	max_hold	Most seconds a change is held back waiting for the status to settle.
+        @param	clock		Callable returning monotonic seconds.
+        '''
+        self.settle = settle
+        self.min_dwell = min_dwell
+        self.max_hold = max_hold
+        self.clock = clock
+        # The last Status announced (None until the first announcement).
+        self.announced = None
+        # The latest Status not announced yet, and when the latest change that matters came in.
+        self.pending = None
+        self.pending_since = None
+        # When the first change since the last announcement came in.
+        self.held_since = None
+        # When the last announcement was released.
+        self.released_at = None
+        self.stats = {'announced': 0, 'suppressed': 0}
+
+    def offer(self, status, bits=state.ALL_MASK):
+        ''' Hand over a Status that differs from the one before it.
+        @param	status	The new Status.
+        @param	bits	Mask of the sensors anyone is told about. Changes to other sensors don't
+        		start the settle window over.
+        '''
+        now = self.clock()
+        if self.pending is not None:
+            # The pending change never made it out.
+            self._suppress(self.pending)
+            if status.diff(self.pending, bits):
+                self.pending_since = now
+        else:
+            self.pending_since = self.held_since = now
+        self.pending = status
+
+    def _suppress(self, status):
+        debug('Debouncer: suppressed %r', status.state)
+        self.stats['suppressed'] += 1
+
+    def due(self):
+        ''' Return the number of seconds until the pending change may be released (0 if it may be
+        now), or None if nothing is pending.
+        '''
+        if self.pending is None:
+            return None
+        now = self.clock()
+        wait = min(self.pending_since + self.settle, self.held_since + self.max_hold) - now
+        if self.released_at is not None:
+            wait = max(wait, self.released_at + self.min_dwell - now)
+        return max(wait, 0)
+
+    def release(self):
+        ''' Take the pending change if it has settled.
+        @return		(previously announced Status or None, Status to announce) or None if there is
+        		nothing to announce yet. A change that ended up back where the last announcement
+        		was is dropped and counted as suppressed.
+        '''
+        if self.due() != 0:
+            return None
+        status, self.pending = self.pending, None
+        self.pending_since = self.held_since = None
+        if self.announced is not None and status.state == self.announced.state:
+            # It flapped back, nothing to say.
+            self._suppress(status)
+            return None
+        previous, self.announced = self.announced, status
+        self.released_at = self.clock()
+        self.stats['announced'] += 1
+        return previous, status
@@ -0,0 +1,147 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import array
+import collections
+import re
+import threading
+import time
+from log import debug, info, warn, error, critical, exception
+
+
+class HistoryEntry(collections.namedtuple('HistoryEntry', ['time_changed', 'time_observed', 'state'])):
+    ''' One status transition.
+    time_changed is the sensor's own timestamp (0 if it had none), time_observed is when the bot saw
+    the change, both unix seconds. state is the packed sensor state (see state.py).
+    '''
+    __slots__ = ()
+
+    @property
+    def time(self):
+        ''' The best time we have for the change '''
+        return self.time_changed or self.time_observed
+
+
+class StatusHistory:
+    ''' Fixed size ring buffer of status transitions, oldest first.
+    The fields are kept in flat arrays so memory use doesn't grow however long the bot runs, and
+    since entries are appended in the order they're observed they can be binary searched by time.
+    '''
+
+    def __init__(self, size=1024):
+        '''
+        @param	size	Number of transitions to keep, the oldest are dropped after that.
+        '''
+        self.size = size
+        self._changed = array.array('d', [0.0]) * size
+        self._observed = array.array('d', [0.0]) * size
+        self._states = array.array('L', [0]) * size
+        # Physical index of the oldest entry and the number of entries.
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        ''' Return the entry at logical index i (0 is the oldest) '''
+        i = (self._start + i) % self.size
+        return HistoryEntry(self._changed[i], self._observed[i], self._states[i])
+
+    def append(self, time_changed, time_observed, packed):
+        ''' Add a transition unless its state is the same as the latest one.
+        @param	time_changed	The sensor's timestamp of the change in unix seconds (0 if unknown).
+        @param	time_observed	When the change was seen in unix seconds, at or after the latest entry's.
+        @param	packed		The packed sensor state.
+        @return			True if it was added, otherwise False.
+        '''
+        with self._lock:
+            if self._count and self._states[(self._start + self._count - 1) % self.size] == packed:
+                return False
+            if self._count < self.size:
+                i = (self._start + self._count) % self.size
+                self._count += 1
+            else:
+                # Full, overwrite the oldest.
+                i = self._start
+                self._start = (self._start + 1) % self.size
+            self._changed[i] = time_changed
+            self._observed[i] = time_observed
+            self._states[i] = packed
+        debug('StatusHistory.append: %r at %s', packed, time_observed)
+        return True
+
+    def latest(self):
+        ''' Return the latest HistoryEntry or None if there are none '''
+        with self._lock:
+            if not self._count:
+                return None
+            return self._entry(self._count - 1)
+
+    def bisect(self, time_observed):
+        ''' Return the logical index of the first entry observed at or after a time, in O(log n).
+        @param	time_observed	Unix seconds.
+        @return			Index from 0 (everything is that new) to len(self) (nothing is).
+        '''
+        with self._lock:
+            low, high = 0, self._count
+            while low < high:
+                middle = (low + high) // 2
+                if self._observed[(self._start + middle) % self.size] < time_observed:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+    def entries(self, start=0):
+        ''' Return the entries from logical index start on, oldest first '''
+        with self._lock:
+            return [self._entry(i) for i in xrange(max(start, 0), self._count)]
+
+    def last(self, count):
+        ''' Return the latest count entries, oldest first '''
+        return self.entries(len(self) - count)
+
+    def since(self, time_observed):
+        ''' Return the entries observed at or after a time, oldest first '''
+        return self.entries(self.bisect(time_observed))
+
+    def state_at(self, time_observed):
+        ''' Return the packed state as of a time, or None if it is older than the history. '''
+        index = self.bisect(time_observed + 1e-6) - 1
+        if index < 0:
+            return None
+        with self._lock:
+            return self._entry(index).state
+
+
+# '<number><unit>' relative times for parse_time(), eg '90m' or '2 days'
+_relative_re = re.compile(r'^\s*(\d+)\s*(m|min|mins|minutes?|h|hours?|d|days?|w|weeks?)\s*(?:ago)?\s*$', re.I)
+_unit_seconds = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# Absolute times for parse_time(), in local time.
+_time_formats = ('%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+def parse_time(text, now=None):
+    ''' Parse a time given to a command.
+    @param	text	A unix timestamp, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' (local time) or a relative
+    			time like '3h', '2 days' or '30 minutes ago'.
+    @param	now	Unix time relative times count back from, defaults to now.
+    @return		Unix seconds.
+    @raise	ValueError	If text isn't any of those.
+    '''
+    if now is None:
+        now = time.time()
+    text = text.strip()
+    if text.isdigit():
+        return float(text)
+    match = _relative_re.match(text)
+    if match:
+        return now - int(match.group(1)) * _unit_seconds[match.group(2)[0].lower()]
+    for time_format in _time_formats:
+        try:
+            return time.mktime(time.strptime(text, time_format))
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized time: %r' % text)
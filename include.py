@@ -1,14 +1,19 @@
 
 import urllib2
+import httplib
 
 plugin_name = 'Status'
 default_msg = 'HacDC is %s since %s'
 
+# The StatusHandler currently polling. This module isn't reloaded along with the plugin, so a
+# reloaded plugin can find the poller it replaces and stop it.
+poller = None
+
 class StatusPluginException(Exception):
 	pass
 
 # tuple of exceptions which should be caught in the update loop
-CatchAllExceptions = (ZeroDivisionError,urllib2.URLError, IOError, urllib2.HTTPError)
+CatchAllExceptions = (ZeroDivisionError,urllib2.URLError, IOError, urllib2.HTTPError, httplib.HTTPException, StatusPluginException)
 
 ''' Notes on what not to catch
 -- should fail --
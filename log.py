@@ -1,22 +1,34 @@
+import logging
 import supybot.log as log
 from include import plugin_name
 
 logger = log.getPluginLogger(plugin_name)
 
-def debug(*args):
-	logger.debug(*args, exc_info=True)
+# Pass format arguments rather than formatting the message first: it is only formatted if
+# the level is enabled. Build anything more expensive than that under `if debug_enabled():`.
+# supybot formats the message with supybot.utils.str.format, which knows %s, %i, %r and %.Nf
+# but not %d.
 
-def info(*args):
-	logger.info(*args, exc_info=False)
+def debug_enabled():
+	''' Return True if debug messages are logged '''
+	return logger.isEnabledFor(logging.DEBUG)
 
-def warn(*args):
-	logger.warning(*args, exc_info=False)
+def debug(msg, *args):
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug(msg, *args)
 
-def error(*args):
-        logger.error(*args, exc_info=True)
+def info(msg, *args):
+	if logger.isEnabledFor(logging.INFO):
+		logger.info(msg, *args)
 
-def critical(*args):
-	logger.critical(*args, exc_info=True)
+def warn(msg, *args):
+	logger.warning(msg, *args)
 
-def exception(*args):
-	logger.exception(*args, exc_info=True)
+def error(msg, *args):
+        logger.error(msg, *args, exc_info=True)
+
+def critical(msg, *args):
+	logger.critical(msg, *args, exc_info=True)
+
+def exception(msg, *args):
+	logger.exception(msg, *args)
@@ -0,0 +1,172 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import collections
+import threading
+from schedule import monotonic
+from log import debug, info, warn, error, critical, exception
+
+
+class TokenBucket:
+    ''' Allow rate events per second on average with bursts of up to burst events '''
+
+    def __init__(self, rate, burst, clock=monotonic):
+        '''
+        @param	rate	Tokens added per second.
+        @param	burst	Most tokens the bucket holds.
+        @param	clock	Callable returning monotonic seconds.
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        ''' Return the number of seconds until a token is available (0 if one is now) '''
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        ''' Take a token.
+        @return		True if there was one, otherwise False.
+        '''
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AnnouncementQueue(threading.Thread):
+    ''' Deliver status announcements to the networks at a rate their servers won't kick us for.
+    Each network gets its own TokenBucket. Only the latest status for a channel is kept, so a newer
+    status never waits behind an obsolete one, and its text is only built when it goes out, against
+    the status the channel last heard about, so nothing is lost when one replaces another.
+    '''
+
+    def __init__(self, rate=1.0, burst=5, clock=monotonic):
+        '''
+        @param	rate	Announcements per second per network.
+        @param	burst	Announcements a network can take at once after a quiet spell.
+        @param	clock	Callable returning monotonic seconds.
+        '''
+        threading.Thread.__init__(self, name='StatusAnnouncements')
+        self.setDaemon(True)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        # (supybot.Irc, channel) -> (previous status, status, build, time queued), oldest first
+        self._pending = collections.OrderedDict()
+        # (supybot.Irc, channel) -> the status the channel last heard about
+        self._delivered = {}
+        # supybot.Irc -> TokenBucket
+        self._buckets = {}
+        self._cond = threading.Condition()
+        # Token for killing the loop. setting this False stops it.
+        self.keep_alive = True
+        self.stats = {'queued': 0, 'coalesced': 0, 'delivered': 0, 'unchanged': 0, 'latency_s': 0.0, 'max_latency_s': 0.0}
+
+    @property
+    def depth(self):
+        ''' Number of announcements waiting to go out '''
+        return len(self._pending)
+
+    def put(self, irc, channel, previous, status, build):
+        ''' Queue an announcement, replacing any still pending for the same channel.
+        @param	irc		supybot.Irc of the network the channel is on.
+        @param	channel		The channel to announce in.
+        @param	previous	The status announced before this one, None if there was none.
+        			Only used if the channel hasn't heard about any status yet.
+        @param	status		The status to announce.
+        @param	build		Callable(channel, status the channel last heard about or None,
+        			status) returning the IrcMsg to send or None if there's nothing to say.
+        '''
+        key = (irc, channel)
+        with self._cond:
+            if key in self._pending:
+                # Superseded before it went out, the new one takes its place at the back and
+                # still gets compared with what the channel heard before the old one.
+                previous = self._pending.pop(key)[0]
+                self.stats['coalesced'] += 1
+            else:
+                previous = self._delivered.get(key, previous)
+            self._pending[key] = (previous, status, build, self.clock())
+            self.stats['queued'] += 1
+            self._cond.notify()
+
+    def _bucket(self, irc):
+        if irc not in self._buckets:
+            self._buckets[irc] = TokenBucket(self.rate, self.burst, self.clock)
+        bucket = self._buckets[irc]
+        # Keep up with config changes.
+        bucket.rate, bucket.burst = self.rate, self.burst
+        return bucket
+
+    def _next(self):
+        ''' Pop the oldest announcement whose network has a token.
+        Announcements whose status turns out to be what the channel last heard about are dropped
+        without using one.
+        @return		(irc, msg, time queued) or the number of seconds until one could go (None if nothing is pending).
+        '''
+        wait = None
+        for key, (previous, status, build, queued) in self._pending.items():
+            irc, channel = key
+            bucket = self._bucket(irc)
+            bucket_wait = bucket.wait()
+            if bucket_wait:
+                wait = bucket_wait if wait is None else min(wait, bucket_wait)
+                continue
+            del self._pending[key]
+            self._delivered[key] = status
+            msg = build(channel, previous, status)
+            if msg is None:
+                # Changed and changed back before it went out.
+                self.stats['unchanged'] += 1
+                continue
+            bucket.take()
+            return irc, msg, queued
+        return wait
+
+    def run(self):
+        ''' Threaded entry point. Delivers announcements until close() is called. '''
+        while True:
+            with self._cond:
+                if not self.keep_alive:
+                    return
+                try:
+                    item = self._next()
+                except Exception:
+                    exception('AnnouncementQueue: failed to build an announcement')
+                    # Don't spin if it keeps failing.
+                    self._cond.wait(1)
+                    continue
+                if not isinstance(item, tuple):
+                    # Nothing that can go yet, sleep until something can or something new comes in.
+                    self._cond.wait(item)
+                    continue
+            irc, msg, queued = item
+            try:
+                irc.queueMsg(msg)
+            except Exception:
+                exception('AnnouncementQueue: failed to deliver to %s', msg.args[0])
+                continue
+            latency = self.clock() - queued
+            self.stats['delivered'] += 1
+            self.stats['latency_s'] = round(latency, 3)
+            self.stats['max_latency_s'] = max(self.stats['max_latency_s'], round(latency, 3))
+            debug('AnnouncementQueue: delivered to %s after %.3f seconds', msg.args[0], latency)
+
+    def close(self):
+        ''' Stop delivering. Announcements still pending are dropped. '''
+        with self._cond:
+            self.keep_alive = False
+            self._cond.notify()
@@ -8,21 +8,274 @@ import supybot.world as world
 import supybot.ircmsgs as ircmsgs
 import threading
 import select
+import json
+import collections
 import time
 import _strptime # required to prevent import errors
 import datetime
+import include
 import update
-from log import debug, info, warn, error, critical, exception
+import history
+from store import HistoryStore
+import state
+from schedule import PollScheduler, Ticker, monotonic
+from debounce import Debouncer
+from retry import CircuitBreaker
+from outbound import AnnouncementQueue
+from settings import Settings
+from log import debug, debug_enabled, info, warn, error, critical, exception
 from include import CatchAllExceptions
 from alien import get_alien_status
 
 
 def min_to_sec(minutes=0):
-    return 60*60*minutes
+    return 60*minutes
+
+# Message to cache if there is no message in the message dict.
+no_status_message = 'No status available yet.'
+
+class StatusSnapshot(collections.namedtuple('StatusSnapshot', ['default', 'human', 'raw', 'time_fetched'])):
+    ''' Immutable copy of the cached status messages.
+    StatusHandler swaps in a whole new one on each change so readers never see a mix of old and new.
+    '''
+    __slots__ = ()
+
+    # registry value name for each field
+    registry_names = {'default': 'message_default', 'human': 'message_human', 'raw': 'message_raw', 'time_fetched': 'time_fetched'}
+
+    @classmethod
+    def from_message(cls, message):
+	''' Build a snapshot from a Status.message dict '''
+        return cls(message['default'] or no_status_message,
+                message['human'] or no_status_message,
+                message['raw'] or no_status_message,
+                message['time_fetched'] or 0)
+
+    @classmethod
+    def from_registry(cls, registryValue):
+	''' Build a snapshot from the values persisted in the registry '''
+        return cls(*[registryValue(cls.registry_names[field]) for field in cls._fields])
+
+# Changes shown at most by the history and since formats.
+max_history_reply = 10
+# Fraction of the time a sensor has to have been on in an hour of the week for the hours format to call it usual.
+usual_ratio = 0.5
+day_names = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# name -> callable(StatusHandler, argument) returning the reply for that format, see register_status_format()
+status_formats = {}
+
+def register_status_format(name, live=True):
+    ''' Decorator registering a format for the status command.
+    Only the callable for the format asked for is called. It gets the StatusHandler and whatever
+    followed the format name (None if nothing did).
+    @param	name	The format argument of the status command.
+    @param	live	True if the format shows the current status, which is refreshed when stale.
+    '''
+    def register(renderer):
+        renderer.live = live
+        status_formats[name] = renderer
+        return renderer
+    return register
+
+@register_status_format('default')
+def default_status(handler, argument):
+    ''' As seen in the automatic status change notifications '''
+    return handler.snapshot.default
+
+@register_status_format('human')
+def human_status(handler, argument):
+    ''' The state of each sensor '''
+    return handler.snapshot.human
+
+@register_status_format('raw')
+def raw_status(handler, argument):
+    ''' The sensor upload verbatim '''
+    return handler.snapshot.raw
+
+@register_status_format('alien', live=False)
+def alien_status(handler, argument):
+    ''' Something only the aliens understand '''
+    return get_alien_status()
+
+@register_status_format('json')
+def json_status(handler, argument):
+    ''' The state of every sensor as JSON '''
+    status = handler.updater.status
+    if not status:
+        return None
+    return json.dumps({'time_changed': status.message['changed'],
+        'time_fetched': status.message['time_fetched'],
+        'sensors': state.decode(status.state)}, sort_keys=True)
+
+@register_status_format('uptime', live=False)
+def uptime_status(handler, argument):
+    ''' How long the status has been polled for '''
+    return 'Polling for %s' % utils.timeElapsed(time.time() - handler.started_at)
+
+@register_status_format('history', live=False)
+def history_status(handler, argument):
+    ''' The last few changes '''
+    try:
+        count = min(int(argument or 5), max_history_reply)
+    except ValueError:
+        return 'history takes a number of changes to show.'
+    # One more for the state before the first one shown.
+    entries = handler.history.last(count + 1)
+    if len(entries) <= count:
+        # The oldest is shown too, nothing is known before it.
+        entries.insert(0, None)
+    return describe_history(entries, count) or 'No changes seen yet.'
+
+@register_status_format('since', live=False)
+def since_status(handler, argument):
+    ''' The changes since a time '''
+    try:
+        since = history.parse_time(argument or '')
+    except ValueError:
+        return 'since takes a time like 2013-05-04, 2013-05-04 18:30 or 3h.'
+    entries = handler.history.entries(handler.history.bisect(since) - 1)
+    if entries and entries[0].time_observed >= since:
+        # Nothing before it, the first entry is news too.
+        entries.insert(0, None)
+    count = len(entries) - 1
+    reply = describe_history(entries, max_history_reply)
+    if not reply:
+        return 'No changes since then.'
+    if count > max_history_reply:
+        reply = '%s (and %d before that)' % (reply, count - max_history_reply)
+    return reply
+
+def find_sensor(name):
+    ''' Return the key of the sensor a user called name (its key or its label), or None. '''
+    name = ' '.join(name.lower().split())
+    if name in ('space', 'hacdc'):
+        return 'lights'
+    for key in state.SENSORS:
+        if name in (key, (update.sensor_label(key) or '').lower()):
+            return key
+    return None
+
+def format_time(when):
+    ''' Format unix seconds for a reply, like the default status message does '''
+    return time.strftime('%I:%M%p %a %d %b', time.localtime(when))
+
+@register_status_format('open', live=False)
+def open_status(handler, argument):
+    ''' The hours open since a time (a week ago by default), from the history store '''
+    if handler.store is None:
+        return 'No history is kept on disk.'
+    try:
+        since = history.parse_time(argument or '1w')
+    except ValueError:
+        return 'open takes a time like 2013-05-04, 2013-05-04 18:30 or 3d.'
+    on, known = handler.store.on_seconds('lights', since, time.time())
+    if not known:
+        return 'No status history since %s.' % format_time(since)
+    return 'Open %.1f hours since %s (%d%% of the time the status is known).' % (on / 3600, format_time(since), 100 * on / known)
+
+@register_status_format('last', live=False)
+def last_status(handler, argument):
+    ''' The last time a sensor was on (or off), from the history store '''
+    if handler.store is None:
+        return 'No history is kept on disk.'
+    words = (argument or '').split()
+    boolean = True
+    if words and words[-1].lower() in ('on', 'off', 'open', 'closed'):
+        boolean = words.pop().lower() in ('on', 'open')
+    key = find_sensor(' '.join(words) or 'lights')
+    if key is None:
+        return 'last takes a sensor (%s) and optionally on or off.' % ', '.join(state.SENSORS)
+    if key == 'lights':
+        subject, value = 'The space', {True: 'open', False: 'closed'}[boolean]
+    else:
+        subject, value = update.sensor_label(key) or key, {True: 'on', False: 'off'}[boolean]
+    period = handler.store.last_period(key, boolean)
+    if period is None:
+        return '%s has not been %s since the history began.' % (subject, value)
+    start, end = period
+    if end is None:
+        return '%s has been %s since %s.' % (subject, value, format_time(start))
+    return '%s was last %s from %s to %s.' % (subject, value, format_time(start), format_time(end))
+
+def format_hour(hour):
+    ''' Format an hour of the day (0 to 24) like 7PM '''
+    return '%d%s' % (hour % 12 or 12, 'AM' if hour % 24 < 12 else 'PM')
+
+@register_status_format('hours', live=False)
+def hours_status(handler, argument):
+    ''' The hours a sensor (the lights unless one is given) is usually on, from the occupancy aggregates '''
+    if handler.store is None:
+        return 'No history is kept on disk.'
+    key = find_sensor(argument or 'lights')
+    if key is None:
+        return 'hours takes a sensor (%s).' % ', '.join(state.SENSORS)
+    ratios = handler.store.aggregates.ratios(key)
+    if all(ratio is None for ratio in ratios):
+        return 'Not enough history yet.'
+    days = []
+    for day, name in enumerate(day_names):
+        usual = [ratio is not None and ratio >= usual_ratio for ratio in ratios[day * 24:(day + 1) * 24]]
+        spans = []
+        for hour in range(24):
+            if usual[hour] and (hour == 0 or not usual[hour - 1]):
+                end = hour
+                while end < 24 and usual[end]:
+                    end += 1
+                spans.append('%s-%s' % (format_hour(hour), format_hour(end)))
+        if spans:
+            days.append('%s %s' % (name, ', '.join(spans)))
+    if key == 'lights':
+        subject, value = 'Usually open', 'open'
+    else:
+        subject, value = '%s is usually on' % (update.sensor_label(key) or key), 'on'
+    if not days:
+        return 'Not usually %s at any hour.' % value
+    # The buckets are in the bot's local time.
+    return '%s: %s (%s)' % (subject, '; '.join(days), time.strftime('%Z'))
+
+def describe_history(entries, count):
+    ''' Describe the latest changes from a list of history entries.
+    @param	entries	List of history.HistoryEntry, oldest first. The first is only used for the state
+    			before the second, None if that isn't known.
+    @param	count	Maximum number of changes to describe.
+    @return		The description, latest change first, or None if there are no changes.
+    '''
+    lines = []
+    for previous, entry in zip(entries, entries[1:])[-count:]:
+        if previous is None or previous.state == state.NONE_KNOWN or entry.state == state.NONE_KNOWN:
+            # Going from or to nothing known, the lights say it all.
+            keys = ['lights']
+            previous_state = 0
+        else:
+            keys = state.diff(previous.state, entry.state)
+            previous_state = previous.state
+        parts = []
+        for key in keys:
+            if key == 'lights':
+                parts.append({True: 'open', False: 'closed', None: 'unknown'}[state.value(entry.state, key)])
+            else:
+                parts.append(str(update.ChangeEvent(key, update.sensor_label(key),
+                        state.value(previous_state, key), state.value(entry.state, key))))
+        lines.append('%s: %s' % (format_time(entry.time), ', '.join(parts)))
+    lines.reverse()
+    return '; '.join(lines) or None
 
 class StatusHandler(threading.Thread):
     # Updater instance
     updater = None
+    # PollScheduler instance
+    scheduler = None
+    # Debouncer instance
+    debouncer = None
+    # AnnouncementQueue instance
+    outbound = None
+    # Settings instance
+    settings = None
+    # StatusHistory instance
+    history = None
+    # HistoryStore instance (None if history isn't kept on disk)
+    store = None
     # Registry of channel states and whether or not to update them.
     channel_states = {}
     # supybot.Irc instance
@@ -34,18 +287,45 @@ class StatusHandler(threading.Thread):
     # Token for killing the while True loop. setting this False stops the loop.
     keep_alive = True
 
+    def __init__(self):
+        threading.Thread.__init__(self, name='StatusHandler')
+        # Set once the bot is connected (001 welcome or our first JOIN).
+        self.connected = threading.Event()
+        # Set to cut any wait short (startup delay, poll interval, retry backoff), see close().
+        self.wakeup = threading.Event()
+        # Unix time the handler was created.
+        self.started_at = time.time()
+        # Seconds spent between the thread starting and the loop starting.
+        self.startup_time = None
+        # Fixed rate deadlines for the poll loop.
+        self.ticker = Ticker()
+        # The current StatusSnapshot, replaced (never modified) on each change.
+        self.snapshot = None
+        # True if self.snapshot has changes that aren't in the registry yet.
+        self._dirty = False
+        # monotonic() time of the last registry write.
+        self._flushed = 0
+        # True while a background refresh is running (see refresh_async()).
+        self._refreshing = False
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
+
     def run(self):
 	''' Threaded entry point. Indefinitely polls the remote server for sensor status. '''
 	debug('StatusHandler.run')
+	started = monotonic()
 	debug('StatusHandler.run: waiting for connect')
-	while not self.irc.afterConnect:
-		pass
+	# Block (without spinning) until the plugin sees the welcome or our join.
+	if self.irc.afterConnect:
+	    self.connected.set()
+	self.connected.wait()
         debug('StatusHandler.run: waiting for a few seconds while i join a channel')
-	timer = 0
-	# time.sleep() seems to do something funny in threads so i'm keeping it to 1 second at a time
-	while timer < (self.registryValue('connect_delay') or 10):
-		timer += 1
-		time.sleep(1)
+	# connect_delay counts from startup, so only wait for whatever is left of it.
+	remaining = (self.settings.current.connect_delay or 10) - (monotonic() - started)
+	if remaining > 0:
+	    self.wakeup.wait(remaining)
+	self.startup_time = monotonic() - started
+	info('StatusHandler.run: startup took %.2f seconds', self.startup_time)
         debug('StatusHandler.run: i  hope i joined a channel ... starting the loop and notifying channel of initial state')
 	# /me sings to the tune of 'the song that never ends'
 	# This is the loop that never ends ...
@@ -55,85 +335,288 @@ class StatusHandler(threading.Thread):
 		if not self.keep_alive:
 			warn('Exiting StatusHandler loop.')
 			return None
-		debug('StatusHandler.run: checking for updates')
+		self.ticker.start()
+		debug('StatusHandler.run: checking for updates (lag %.3fs)', self.ticker.lag)
 		# Check for a new status.
                 message = self.updater.check()
-                debug('StatusHandler.run.message:', str(message))
+                debug('StatusHandler.run.message: %s', message)
+		# Closed while checking, don't announce anything on the way out.
+		if not self.keep_alive:
+		    continue
+		# And for individual sensors changing.
+		events = self.updater.pop_events()
 		# Check we have all the bits we need. and continue if we do.
                 if isinstance(message, dict) and message.get('human') and message.get('raw') and message.get('default'):
 		    debug('StatusHandler.run: got a message')
-		    # Update the status cache (bot config values).
-                    self._update_registry(message)
-		    debug('StatusHandler.run: updated registry')
-		    # Shout the new from the rooftops
-                    self._notify_channels()
-		    debug('StatusHandler.run: notified channels')
-		debug('StatusHandler.run.interval', str(self.registryValue('interval')))
-		# Sleep for a few seconds so we don't go nuts on the processor and http server.
-                time.sleep(self.registryValue('interval'))
-		debug('StatusHandler.run: slept for %d seconds' % self.registryValue('interval'))
+		    # Update the status cache.
+                    self._update_snapshot(message)
+		    debug('StatusHandler.run: updated snapshot')
+		    # Queue it up to be shouted from the rooftops once it settles.
+		    self.debouncer.offer(self.updater.status, self._subscribed())
+		    # Poll quickly again right after a change.
+		    # Learnt on the local clock it schedules by, not the sensor's timestamp which is in the sensor's zone.
+		    self.scheduler.changed()
+		elif events:
+		    # Only some sensors changed, keep the cache current and queue them up too.
+		    self._update_snapshot(self.updater.status.message)
+		    self.debouncer.offer(self.updater.status, self._subscribed())
+		    self.scheduler.changed(learn=False)
+		else:
+		    # Back off while nothing is happening.
+		    self.scheduler.unchanged()
+		if self.updater.breaker.state != CircuitBreaker.CLOSED:
+		    # The source is down, the sensors could be doing anything.
+		    self.record_unknown()
+		elif self.updater.status is not None:
+		    # A change, or the same status known again after the source or the bot was down.
+		    self._record(self.updater.status)
+		# Shout whatever has settled from the rooftops
+		self._announce()
+		# Persist the cache now and then rather than on every change.
+		self.flush_registry()
+		interval = self._next_interval()
+		# Don't sleep past the time a pending change is due to be announced.
+		due = self.debouncer.due()
+		if due is not None:
+		    interval = min(interval, max(due, 1))
+		debug('StatusHandler.run.interval %s', interval)
             except CatchAllExceptions as e:
-	        error('StatusHandler.run: error', e)
+	        error('StatusHandler.run: error %r', e)
                 ircmsgs.error('Exception: %s' % repr(e))
+		interval = self.scheduler.min_interval
+	    # Sleep until the next deadline so we don't go nuts on the processor and http server.
+	    wait = self.ticker.advance(interval)
+            self.wakeup.wait(wait)
+	    debug('StatusHandler.run: slept for %.3f seconds', wait)
 
-    def _notify_channels(self):
-	''' Tell the channels we're supposed to tell there has been a change in status. '''
+    def _record(self, status):
+	''' Add a new status to the history, and to the store on disk if there is one. '''
+	time_changed, time_observed = update.unix_time(status), time.time()
+	if self.history.append(time_changed, time_observed, status.state) and self.store is not None:
+	    digest = self.updater.digest and self.updater.digest.encode('hex')
+	    self.store.put(time_changed, time_observed, status.state, digest)
+
+    def record_unknown(self):
+	''' Record that the sensors can't be seen from now on (the bot is starting or stopping, or the source is down),
+	so the history doesn't credit that time to the last status seen.
+	'''
+	now = time.time()
+	if self.history.append(0, now, state.NONE_KNOWN) and self.store is not None:
+	    self.store.put(0, now, state.NONE_KNOWN)
+
+    def _next_interval(self):
+	''' Return the number of seconds to wait before the next poll, keeping the scheduler's bounds in step with the config. '''
+	config = self.settings.current
+	self.scheduler.min_interval = config.interval
+	self.scheduler.max_interval = max(config.max_interval, config.interval)
+	self.scheduler.backoff = config.backoff
+	return self.scheduler.next_interval()
+
+    def _announce(self):
+	''' Notify channels of the change the debouncer let through, if there is one. '''
+	config = self.settings.current
+	self.debouncer.settle = config.settle_window
+	self.debouncer.min_dwell = config.min_dwell
+	self.debouncer.max_hold = config.max_hold
+	self.outbound.rate = config.announce_rate
+	self.outbound.burst = config.announce_burst
+	# What counts as a new status, checked from the next poll on.
+	self.updater.change_mask = state.change_masks.get(config.change_detection, state.LIGHTS_MASK)
+	released = self.debouncer.release()
+	if not released:
+	    return
+	previous, status = released
+	self._notify_channels(previous, status)
+	debug('StatusHandler._announce: notified channels')
+
+    def _subscribed(self):
+	''' Return the state.mask of the sensors any channel that gets announcements subscribes to. '''
+	config = self.settings.current
+	keys = set()
 	for irc in world.ircs:
-            for channel in [x for x in irc.state.channels if x not in self.registryValue('quiet_channels')]:
-            	self._notify_channel(channel)
-
-    def _notify_channel(self, channel):
-	''' Tell an individual channel about the change in status. '''
-	debug('StatusHandler._notify_channel:', channel)
-        if channel not in self.registryValue('quiet_channels'):
-	    # If this channel is supposed to recieve updates.
-            if self.registryValue('use_notice'):
-	       # And it is supposed to get a /NOTICE rather than /PRIVMSG.
-	       # Then send a notice.
-               msg = ircmsgs.notice(channel, self.registryValue('message_default'))
-            else:
-	       # Otherwise just use a /PRIVMSG.
-               msg = ircmsgs.privmsg(channel, self.registryValue('message_default'))
-	    self.irc.queueMsg(msg)
+	    for channel in irc.state.channels:
+		if channel not in config.quiet_channels:
+		    keys.update(self.settings.sensors(channel))
+	return state.mask(key for key in keys if key in state.SENSORS)
+
+    def _notify_channels(self, previous, status):
+	''' Tell the channels we're supposed to tell there has been a change in status.
+	@param	previous	The update.Status announced before, None if there was none.
+	@param	status		The update.Status to announce.
+	'''
+	for irc, channel, build in self._fan_out():
+	    # Rate limited per network, and replaces anything still pending for the channel.
+	    self.outbound.put(irc, channel, previous, status, build)
+
+    def _fan_out(self):
+	''' Find every channel that should hear about a change, on every network.
+	Settings are read once per change and channels subscribed to the same sensors share a
+	builder, so each distinct text is only built once.
+	@return	List of (supybot.Irc the channel is on, channel, message builder for AnnouncementQueue.put).
+	'''
+	config = self.settings.current
+	# /NOTICE rather than /PRIVMSG if we're supposed to.
+	make_msg = config.use_notice and ircmsgs.notice or ircmsgs.privmsg
+	builders = {}
+	channels = []
+	for irc in world.ircs:
+	    for channel in irc.state.channels:
+		if channel in config.quiet_channels:
+		    continue
+		sensors = self.settings.sensors(channel)
+		if sensors not in builders:
+		    builders[sensors] = self._builder(sensors, make_msg)
+		debug('StatusHandler._fan_out: %s', channel)
+		channels.append((irc, channel, builders[sensors]))
+	return channels
+
+    def _builder(self, sensors, make_msg):
+	''' Return a callable building the message for channels subscribed to some sensors from the
+	status a channel last heard about and the status to announce.
+	'''
+	texts = {}
+	def build(channel, previous, status):
+	    key = (None if previous is None else previous.state, status.state, status.time_changed)
+	    if key not in texts:
+		texts[key] = self._channel_text(sensors, previous, status)
+	    return texts[key] and make_msg(channel, texts[key])
+	return build
 
-    def close(self):
-	''' Stop this thread. '''
+    def _channel_text(self, sensors, previous, status):
+	''' Build the notification for channels subscribed to some sensors.
+	@param	sensors		The keys of the sensors the channel subscribes to.
+	@param	previous	The update.Status the channel last heard about, None if it hasn't.
+	@param	status		The update.Status to announce.
+	@return	The text to send or None if nothing the channel cares about changed.
+	'''
+	if previous is None:
+	    # The first announcement is the state we started up with.
+	    events, new_status = [], True
+	else:
+	    # Everything that changed since the last announcement, however many flips it took.
+	    events = status.changes(previous)
+	    new_status = bool(status.diff(previous, self.updater.change_mask))
+	parts = []
+	if new_status and 'lights' in sensors and status.message['default']:
+	    # The overall state gets the traditional message (there is none while the lights are unknown).
+	    parts.append(status.message['default'])
+	# Other sensors get one 'label: old -> new' each.
+	parts.extend(str(event) for event in events if event.key != 'lights' and event.key in sensors)
+	return '; '.join(parts) or None
+
+    def close(self, timeout=None):
+	''' Stop this thread, the announcement queue, any background refresh and the history store.
+	@param	timeout	Seconds to wait for them to finish, None to not wait.
+	'''
     	self.keep_alive = False
+	# Release whatever wait the thread is in.
+	self.wakeup.set()
+	self.connected.set()
+	# And cut short the request it may be in the middle of.
+	self.updater.pool.abort()
+	self.outbound.close()
+	if timeout is not None:
+	    deadline = monotonic() + timeout
+	    self._join((self, self.outbound, self._refresh_thread), deadline)
+	if self.store is not None:
+	    # Nothing more gets recorded now, let it write whatever is queued and stop.
+	    self.record_unknown()
+	    self.store.close()
+	    if timeout is not None:
+		self._join((self.store,), deadline)
+	# Don't lose the latest status.
+	self.flush_registry(force=True)
+
+    def _join(self, threads, deadline):
+	''' Wait until a monotonic() deadline for threads to finish. '''
+	for thread in threads:
+	    if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+		thread.join(max(deadline - monotonic(), 0))
+		if thread.is_alive():
+		    warn('StatusHandler.close: %s still running', thread.name)
 
     def initialize_status(self, force=False):
 	''' Initialize the status cache if needed.
-	@param	force	If True it forces the registry to be set.
+	@param	force	If True it forces the cache to be set from a fresh status.
 	'''
-	# Get the existing values in the cache.
-        reg_vals = [self.registryValue('message_default'),
-                self.registryValue('message_human'), 
-                self.registryValue('message_raw'),
-		self.registryValue('time_fetched')]
-        debug('StatusHandler._initialize_status.reg_vals:', str(reg_vals))
+	# Start from the values persisted in the registry.
+	if self.snapshot is None:
+	    self.snapshot = StatusSnapshot.from_registry(self.registryValue)
+	reg_vals = list(self.snapshot)
+        debug('StatusHandler._initialize_status.reg_vals: %s', reg_vals)
 	# If any cached values are not set or we are forcing an update.
         if (None in reg_vals or '' in [str(x).strip() for x in reg_vals]) or force:
 	    # Get a fresh status.
             self.updater.get_status()
 	    # And update the cache.
-            self._update_registry(self.updater.status.message)
+	    if self.updater.status:
+		self._update_snapshot(self.updater.status.message)
+
+    def refresh_async(self):
+	''' Refresh the status cache in a background thread unless a refresh is already running.
+	@return	True if a refresh was started, otherwise False.
+	'''
+	with self._refresh_lock:
+	    if self._refreshing:
+		return False
+	    self._refreshing = True
+	thread = self._refresh_thread = threading.Thread(target=self._refresh, name='StatusRefresh')
+	thread.setDaemon(True)
+	thread.start()
+	return True
+
+    def _refresh(self):
+	''' Body of the background refresh started by refresh_async(). '''
+	try:
+	    self.initialize_status(force=True)
+	except CatchAllExceptions as e:
+	    error('StatusHandler._refresh: error %r', e)
+	finally:
+	    self._refreshing = False
 
-    def _update_registry(self, message):
-	''' Update the cached status values 
+    def status_age(self):
+	''' Return the number of seconds since the source last answered, or None if it never has. '''
+	time_fetched = self.updater.time_fetched or self.snapshot.time_fetched
+	if not time_fetched:
+	    return None
+	return max(time.time() - time_fetched, 0)
+
+    def _update_snapshot(self, message):
+	''' Replace the cached status values in one go, the registry catches up in flush_registry().
 	@param	message	The message dict of the status
 	'''
-	debug('StatusHandler._update_registry: updating cached values')
-	# Set the message to cache if there is no message in the message dict.
-        no_status_message = 'No status available yet.'
-	# Set the values of the messages in the cache with their counterparts in the message dict.
-        self.setRegistryValue('message_default', message['default'] or no_status_message)
-        self.setRegistryValue('message_human', message['human'] or no_status_message)
-        self.setRegistryValue('message_raw', message['raw'] or no_status_message)
-	self.setRegistryValue('time_fetched', message['time_fetched'] or 0)
+	debug('StatusHandler._update_snapshot: updating cached values')
+	snapshot = StatusSnapshot.from_message(message)
+	if snapshot != self.snapshot:
+	    self.snapshot = snapshot
+	    self._dirty = True
+
+    def flush_registry(self, force=False):
+	''' Write the cached status values to the registry if they changed.
+	Writes are batched to at most one every registry_flush_interval seconds unless forced.
+	@param	force	If True write now regardless of when the last write was.
+	'''
+	if not self._dirty:
+	    return
+	if not force and monotonic() - self._flushed < self.settings.current.registry_flush_interval:
+	    return
+	self._dirty = False
+	self._flushed = monotonic()
+	snapshot = self.snapshot
+	debug('StatusHandler.flush_registry: writing cached values')
+	for field in snapshot._fields:
+	    name = StatusSnapshot.registry_names[field]
+	    value = getattr(snapshot, field)
+	    # Only touch the values that actually changed.
+	    if self.registryValue(name) != value:
+		self.setRegistryValue(name, value)
 
 class Status(callbacks.Plugin):
     '''This plugin checks an http server for updates and announces changes an IRC channel.'''
 
     threaded = True
+    # Seconds die() waits for the StatusHandler threads to stop.
+    shutdown_timeout = 2
 
     def __init__(self, irc):
 	''' <status|updates|sensordata>
@@ -147,14 +630,40 @@ class Status(callbacks.Plugin):
 	'''
         self.__parent = super(Status, self)
         self.__parent.__init__(irc)
+	# Settings read once and cached until they change.
+        self.settings = Settings(self.registryValue)
+        config = self.settings.current
 	# StatusHandler thread instance
         self.status_handler = StatusHandler()
 	# pass stuff along so it can access irc and config related stuff
         self.status_handler.irc = irc
         self.status_handler.registryValue = self.registryValue
         self.status_handler.setRegistryValue = self.setRegistryValue
+        self.status_handler.settings = self.settings
         self.status_handler.channel_states = {}
-        self.status_handler.updater = update.Updater(source_url=self.registryValue('source_url'))
+	# Only ever one poller, stop the one a reload or an unclean unload left behind before
+	# opening the history store it may still be writing to.
+	if include.poller is not None:
+	    include.poller.close(self.shutdown_timeout)
+	    include.poller.settings.close()
+        self.status_handler.history = history.StatusHistory(config.history_size)
+        if config.history_db:
+            self.status_handler.store = HistoryStore(conf.supybot.directories.data.dirize(config.history_db))
+	    # Pick up where the last run left off.
+            for row in self.status_handler.store.recent(config.history_size):
+                self.status_handler.history.append(*row)
+            self.status_handler.store.start()
+	# Whatever happened while the bot wasn't running isn't known.
+        self.status_handler.record_unknown()
+        self.status_handler.updater = update.Updater(source_url=config.source_url,
+                change_detection=config.change_detection)
+	# Back off between retries without holding up shutdown.
+        self.status_handler.updater.retry.sleep = self.status_handler.wakeup.wait
+        self.status_handler.outbound = AnnouncementQueue(config.announce_rate, config.announce_burst)
+        self.status_handler.outbound.start()
+        self.status_handler.debouncer = Debouncer(config.settle_window, config.min_dwell, config.max_hold)
+        self.status_handler.scheduler = PollScheduler(config.interval, config.max_interval, config.backoff)
+	include.poller = self.status_handler
 	# Initialize status values so we can have them ready once we start.
         self.status_handler.initialize_status()
 	# Set to run in daemon mode (see threading docs)
@@ -162,17 +671,34 @@ class Status(callbacks.Plugin):
 	# Start the Status_handler
         self.status_handler.start()
 
+    def do001(self, irc, msg):
+        ''' Release the StatusHandler startup gate once the server welcomes us. '''
+        self.status_handler.connected.set()
+
+    def doJoin(self, irc, msg):
+        ''' Release the StatusHandler startup gate on our own first join. '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self.status_handler.connected.set()
+
     def __debug_callback_args(self, *args,**kwargs):
-	args_l = [str(x) for x in args] + ['%s:%s' % (x,y) for x,y in kwargs.items()]
-        debug('command callback arguments:', *args_l)
+	if debug_enabled():
+	    args_l = [str(x) for x in args] + ['%s:%s' % (x,y) for x,y in kwargs.items()]
+	    debug('command callback arguments: %s', ' '.join(args_l))
 
     def status(self, irc, msg, args, message_format):
-	''' [default|human|raw] 
+	''' [default|human|raw|json|uptime|history [<count>]|since <time>|open [<time>]|last [<sensor>] [on|off]|hours [<sensor>]] 
 
 	Display the status of the space in a given format (default is 'default' ... who'da thunk).
 	default - as seen in the automatic status change notifications
 	human - a human friendly representation of the state of individual sensors
 	raw - the verbatim string retrived from the sensor's upload
+	json - the state of every sensor as JSON
+	uptime - how long the status has been polled for
+	history - the last few changes (5 unless a count is given)
+	since - the changes since a time (2013-05-04, '2013-05-04 18:30', 3h, 2 days ...)
+	open - the hours open since a time (a week ago unless one is given)
+	last - the last time a sensor (the lights unless one is given) was on, or off
+	hours - the hours a sensor (the lights unless one is given) is usually on
 
 	# method arguments as dict for reference
 	# {'irc': '<supybot.callbacks.NestedCommandsIrcProxy object at 0xa26e1ec>',
@@ -190,20 +716,26 @@ class Status(callbacks.Plugin):
 	@param	message_format	message format argument
 	'''
         self.__debug_callback_args(irc=irc, msg=msg, args=args, message_format=message_format)
-        if not message_format:
-            message_format = 'default'
-        formats = {'default':self.registryValue('message_default'),
-            'human':self.registryValue('message_human'),
-            'raw':self.registryValue('message_raw'),
-	    'alien':get_alien_status() }
-        if message_format not in formats:
+        name, _, argument = (message_format or 'default').strip().partition(' ')
+        # Only the format asked for is rendered.
+        render = status_formats.get(name.lower())
+        if render is None:
 	    nick = msg.prefix.split('!',1)[0].strip(':')
 	    irc.reply('''I'm sorry %s. I'm afraid I can't do that.''' % nick)
+        elif not render.live:
+	    # Nothing to refresh, and no network I/O.
+	    irc.reply(render(self.status_handler, argument.strip() or None))
         else:
-	    if time.mktime(time.gmtime())-self.registryValue('time_fetched') > self.registryValue('max_status_age'):
-		self.status_handler.initialize_status(force=True)
-		debug('Fetching fresh status ')
-            irc.reply("%s" % formats.get(message_format) or 'No status is available yet.')
+	    reply = render(self.status_handler, argument.strip() or None) or 'No status is available yet.'
+	    # Always answer from the cache, a stale cache is refreshed in the background.
+	    age = self.status_handler.status_age()
+	    config = self.settings.current
+	    if age is None or age > min_to_sec(config.max_status_age):
+		if self.status_handler.refresh_async():
+		    debug('Fetching fresh status in the background')
+		if age is not None and config.show_status_age:
+		    reply = '%s (as of %d min ago)' % (reply, age // 60)
+            irc.reply(reply)
 
     def updates(self, irc, msg, args, channel, state):
         ''' <on|off>
@@ -219,9 +751,9 @@ class Status(callbacks.Plugin):
         @param  state		state argument
 	'''
         self.__debug_callback_args(irc=irc, msg=msg, args=args, channel=channel, state=state)
-        qchannels = self.registryValue('quiet_channels')
+        qchannels = list(self.registryValue('quiet_channels'))
         if state is None:
-	    if channel in self.registryValue('quiet_channels'):
+	    if channel in self.settings.current.quiet_channels:
 		state = "off"
 	    else:
 		state = "on"
@@ -229,7 +761,7 @@ class Status(callbacks.Plugin):
         else:
             if state == "on":
                 if channel in qchannels:
-		    qchannels.pop(channel)
+		    qchannels.remove(channel)
                 irc.reply("Updates for %s are now on" % channel )
             else:
 		if channel not in qchannels:
@@ -238,10 +770,12 @@ class Status(callbacks.Plugin):
 	    self.setRegistryValue('quiet_channels', qchannels)
 
     def sensordata(self, irc, msg, args, action):
-	''' <reload>
+	''' <reload|stats|rebuild>
 
 	Manage sensor data.
 	reload - forces a reload of the sensor data from the remote source.
+	stats - show counters for the polling of the remote source.
+	rebuild - rebuild the usual hours from the status history.
 
         @param  irc     supybot supybot.callbacks.NestedCommandsIrcProxy
         @param  msg	supybot IrcMsg instance (from supybot/src/ircmsgs.py)
@@ -252,6 +786,23 @@ class Status(callbacks.Plugin):
         if action == 'reload':
             self.status_handler.initialize_status(force=True)
             irc.reply('Forcing update of all sensor data')
+        elif action == 'stats':
+            stats = dict(self.status_handler.updater.stats)
+            stats.update(self.status_handler.ticker.stats)
+            stats.update(self.status_handler.debouncer.stats)
+            stats.update(('outbound_%s' % k, v) for k, v in self.status_handler.outbound.stats.items())
+            stats['outbound_depth'] = self.status_handler.outbound.depth
+            if self.status_handler.store is not None:
+                stats.update(('store_%s' % k, v) for k, v in self.status_handler.store.stats.items())
+            if self.status_handler.startup_time is not None:
+                stats['startup_s'] = '%.1f' % self.status_handler.startup_time
+            irc.reply(', '.join('%s: %s' % (k, stats[k]) for k in sorted(stats)))
+        elif action == 'rebuild':
+            if self.status_handler.store is None:
+                irc.reply('No history is kept on disk.')
+            else:
+                self.status_handler.store.rebuild_aggregates()
+                irc.reply('Rebuilding the usual hours from the status history')
     
     # wrap methods for use as commands
     updates = wrap(updates, ['inChannel', 'admin', optional('boolean')])
@@ -261,7 +812,10 @@ class Status(callbacks.Plugin):
     def die(self):
 	''' Stop the plugin entirely. '''
 	# Stop the StatusHandler
-        self.status_handler.close()
+        self.status_handler.close(self.shutdown_timeout)
+        self.settings.close()
+	if include.poller is self.status_handler:
+	    include.poller = None
         self.__parent.die()
 
 Class = Status
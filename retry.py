@@ -0,0 +1,107 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import random
+import time
+from schedule import monotonic
+from log import debug, info, warn, error, critical, exception
+
+
+class RetryPolicy:
+    ''' Retry a call a bounded number of times with exponential backoff and full jitter,
+    giving up early rather than running past an overall deadline.
+    '''
+
+    def __init__(self, attempts=3, base=1.0, cap=10.0, deadline=30.0, clock=monotonic, sleep=time.sleep):
+        '''
+        @param	attempts	Maximum number of calls.
+        @param	base		Backoff before the first retry in seconds (before jitter).
+        @param	cap		Longest backoff in seconds (before jitter).
+        @param	deadline	Seconds after the first call no more retries are started.
+        @param	clock		Callable returning monotonic seconds.
+        @param	sleep		Callable taking seconds to wait between attempts.
+        '''
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+
+    def backoff(self, attempt):
+        ''' Return the seconds to wait after a failed attempt (counting from 0) '''
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def call(self, function, retry_on):
+        ''' Call function until it returns without raising one of retry_on.
+        @param	function	Callable taking no arguments.
+        @param	retry_on	Tuple of exceptions that are worth another try.
+        @return			Whatever function returns.
+        @raise			The last exception if every attempt failed or the deadline was reached.
+        '''
+        started = self.clock()
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except retry_on as e:
+                delay = self.backoff(attempt)
+                attempt += 1
+                if attempt >= self.attempts or self.clock() - started + delay > self.deadline:
+                    raise
+                debug('RetryPolicy.call: attempt %s failed (%r), retrying in %.2f seconds', attempt, e, delay)
+                self.sleep(delay)
+
+
+class CircuitBreaker:
+    ''' Stop calling a source that keeps failing, and probe it now and then until it recovers.
+    closed - calls go through, failures are counted.
+    open - calls are refused until reset_timeout has passed.
+    half-open - one probe call is let through, it closes the breaker or opens it again.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=60.0, clock=monotonic):
+        '''
+        @param	threshold	Consecutive failures that open the breaker.
+        @param	reset_timeout	Seconds to wait before probing an open breaker.
+        @param	clock		Callable returning monotonic seconds.
+        '''
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        ''' Test if a call may go through now.
+        @return		True if the breaker is closed or it is time for a probe, otherwise False.
+        '''
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+            info('CircuitBreaker: probing')
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        ''' Record a call that worked, closing the breaker '''
+        if self.state != self.CLOSED:
+            info('CircuitBreaker: closed')
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        ''' Record a call that failed, opening the breaker at the threshold or after a failed probe '''
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                warn('CircuitBreaker: open after %s failures', self.failures)
+            self.state = self.OPEN
+            self.opened_at = self.clock()
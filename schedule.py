@@ -0,0 +1,149 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import ctypes
+import ctypes.util
+import datetime
+import sys
+import time
+from log import debug, info, warn, error, critical, exception
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# clock_gettime(CLOCK_MONOTONIC) where libc has it, python 2 has no monotonic clock of its own.
+# The clock ids differ between systems, 1 is CLOCK_MONOTONIC on Linux, so only use it there.
+CLOCK_MONOTONIC = 1
+_clock_gettime = None
+if sys.platform.startswith('linux'):
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        # Make sure it works once rather than finding out in the poll loop.
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_timespec())) != 0:
+            _clock_gettime = None
+    except (OSError, AttributeError):
+        _clock_gettime = None
+
+def monotonic():
+    ''' Return seconds on a clock that never goes backwards (falls back to time.time(), never raises) '''
+    if _clock_gettime is not None:
+        ts = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) == 0:
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    return time.time()
+
+
+class PollScheduler:
+    ''' Decide how long to wait before the next poll.
+    The interval backs off exponentially while the status is stable and drops back to the
+    minimum as soon as it changes. Hours of the day in which the status has often changed
+    before are polled at the minimum interval regardless.
+    '''
+
+    # Number of recorded changes before the time of day profile is trusted.
+    profile_min_samples = 10
+    # An hour is busy if it has this many times its share of the recorded changes.
+    profile_busy_factor = 2.0
+
+    def __init__(self, min_interval, max_interval, backoff=2.0):
+        '''
+        @param	min_interval	Shortest wait between polls in seconds.
+        @param	max_interval	Longest wait between polls in seconds.
+        @param	backoff		Factor the wait grows by after each poll without a change.
+        '''
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # The current wait between polls before the profile is applied.
+        self.interval = min_interval
+        # Number of changes seen in each hour of the day.
+        self.profile = [0] * 24
+
+    def changed(self, learn=True, now=None):
+        ''' Note a change of status. Tightens the interval and learns the hour it was seen in.
+        @param	learn	If False only tighten the interval, the change doesn't count towards the profile.
+        @param	now	datetime the change was seen at. Defaults to the current local time, the
+        		same clock next_interval() schedules from.
+        '''
+        self.interval = self.min_interval
+        if learn:
+            self.profile[(now or datetime.datetime.now()).hour] += 1
+
+    def unchanged(self):
+        ''' Note a poll without a change. Backs the interval off. '''
+        self.interval = min(max(self.interval, self.min_interval) * self.backoff, self.max_interval)
+
+    def busy(self, hour):
+        ''' Test if changes are common in an hour of the day.
+        @param	hour	Hour of the day (0-23).
+        @return		True if the profile has enough samples and the hour has well above its share of them.
+        '''
+        total = sum(self.profile)
+        if total < self.profile_min_samples:
+            return False
+        return self.profile[hour] * 24 >= total * self.profile_busy_factor
+
+    def next_interval(self, now=None):
+        ''' Return the number of seconds to wait before the next poll.
+        @param	now	datetime to schedule from. Defaults to the current local time.
+        '''
+        now = now or datetime.datetime.now()
+        # Stay alert in busy hours and in the hour leading up to one.
+        if self.busy(now.hour) or self.busy((now.hour + 1) % 24):
+            interval = self.min_interval
+        else:
+            interval = self.interval
+        return max(self.min_interval, min(interval, self.max_interval))
+
+
+class Ticker:
+    ''' Fixed rate deadlines on the monotonic clock.
+    Each deadline is the last one plus the interval, not the time the last poll finished plus
+    the interval, so slow polls don't stretch the period. Deadlines that have already passed
+    by the time a poll finishes are skipped rather than run back to back.
+    '''
+
+    def __init__(self, clock=monotonic):
+        '''
+        @param	clock	Callable returning monotonic seconds.
+        '''
+        self.clock = clock
+        # The time the current tick was due.
+        self.deadline = None
+        # Seconds between the deadline and the tick actually starting, for the last tick and worst tick.
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # Number of ticks started and deadlines skipped because the loop fell behind.
+        self.ticks = 0
+        self.skipped = 0
+
+    def start(self):
+        ''' Start a tick, recording how late it is. '''
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        self.lag = max(now - self.deadline, 0.0)
+        self.max_lag = max(self.max_lag, self.lag)
+        self.ticks += 1
+
+    def advance(self, interval):
+        ''' Move to the next deadline.
+        @param	interval	Seconds between this deadline and the next.
+        @return			Seconds to wait until the next deadline.
+        '''
+        self.deadline += interval
+        now = self.clock()
+        if now > self.deadline and interval > 0:
+            missed = int((now - self.deadline) // interval) + 1
+            debug('Ticker.advance: fell behind, skipping %s ticks', missed)
+            self.skipped += missed
+            self.deadline += missed * interval
+        return max(self.deadline - now, 0.0)
+
+    @property
+    def stats(self):
+        ''' dict of the timing counters '''
+        return {'ticks': self.ticks, 'skipped_ticks': self.skipped, 'lag_s': round(self.lag, 3), 'max_lag_s': round(self.max_lag, 3)}
@@ -0,0 +1,108 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import collections
+from schedule import monotonic
+from log import debug, info, warn, error, critical, exception
+
+# Global settings copied into a ConfigSnapshot (see config.py).
+setting_names = ('use_notice', 'source_url', 'change_detection', 'quiet_channels',
+        'announce_rate', 'announce_burst', 'interval', 'max_interval', 'backoff',
+        'connect_delay', 'settle_window', 'min_dwell', 'max_hold', 'max_status_age', 'show_status_age',
+        'registry_flush_interval', 'history_size', 'history_db')
+
+class ConfigSnapshot(collections.namedtuple('ConfigSnapshot', setting_names)):
+    ''' Immutable copy of the plugin's global settings.
+    quiet_channels is a frozenset so it can be tested without copying it.
+    '''
+    __slots__ = ()
+
+
+class Settings:
+    ''' The plugin's settings read with plain attribute access.
+    Registry values are copied into a ConfigSnapshot once and only copied again after a registry
+    callback says one of them changed, so the poll loop, the notifications and the commands
+    don't go through a registry lookup each time they need a setting.
+    Registry values only have callbacks in Limnoria. With stock Supybot the values are read
+    again once they're refresh seconds old instead.
+    '''
+
+    # Seconds the values are trusted for when the registry has no callbacks.
+    refresh = 5
+
+    def __init__(self, registryValue, clock=monotonic):
+        '''
+        @param	registryValue	The plugin's registryValue method.
+        @param	clock		Callable returning monotonic seconds.
+        '''
+        self.registryValue = registryValue
+        self.clock = clock
+        # The current ConfigSnapshot, None once a setting has changed.
+        self._snapshot = None
+        # channel -> tuple of the sensors the channel subscribes to
+        self._sensors = {}
+        # clock() time the cached values were first read since they were last dropped.
+        self._read_at = None
+        # Channels whose registry values we've hooked already.
+        self._hooked = set()
+        # removeCallback compares with is, and every self.invalidate is a new bound method.
+        self._invalidate = self.invalidate
+        values = [self.registryValue(name, value=False) for name in setting_names + ('sensors',)]
+        self.callbacks = all(hasattr(value, 'addCallback') for value in values)
+        if self.callbacks:
+            for value in values:
+                value.addCallback(self._invalidate)
+
+    def invalidate(self):
+        ''' Drop the cached values, they're read again next time they're needed. '''
+        debug('Settings.invalidate: registry changed')
+        self._snapshot = None
+        self._sensors = {}
+        self._read_at = None
+
+    def _expire(self):
+        ''' Without callbacks, drop the cached values once they're refresh seconds old. '''
+        if self.callbacks:
+            return
+        now = self.clock()
+        if self._read_at is None:
+            self._read_at = now
+        elif now - self._read_at >= self.refresh:
+            self.invalidate()
+            self._read_at = now
+
+    def close(self):
+        ''' Remove the registry callbacks, so the registry doesn't keep this instance alive after a reload. '''
+        if not self.callbacks:
+            return
+        values = [self.registryValue(name, value=False) for name in setting_names + ('sensors',)]
+        values.extend(self.registryValue('sensors', channel, value=False) for channel in self._hooked)
+        for value in values:
+            value.removeCallback(self._invalidate)
+        self._hooked.clear()
+
+    @property
+    def current(self):
+        ''' The current ConfigSnapshot '''
+        self._expire()
+        snapshot = self._snapshot
+        if snapshot is None:
+            values = dict((name, self.registryValue(name)) for name in setting_names)
+            values['quiet_channels'] = frozenset(values['quiet_channels'])
+            snapshot = self._snapshot = ConfigSnapshot(**values)
+        return snapshot
+
+    def sensors(self, channel):
+        ''' Return the sensors a channel subscribes to as a tuple. '''
+        self._expire()
+        try:
+            return self._sensors[channel]
+        except KeyError:
+            pass
+        if self.callbacks and channel not in self._hooked:
+            # Channel specific values are separate registry entries with their own callbacks.
+            self.registryValue('sensors', channel, value=False).addCallback(self._invalidate)
+            self._hooked.add(channel)
+        sensors = self._sensors[channel] = tuple(self.registryValue('sensors', channel))
+        return sensors
@@ -0,0 +1,88 @@
+''' Sensor states packed into a small integer.
+Every sensor gets two bits (unknown, off or on) at a fixed position and the schema version sits
+above them, so comparing, hashing, diffing and storing a whole status are all integer operations.
+'''
+
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+# Bump this if SENSORS changes so old packed states can be told apart.
+SCHEMA_VERSION = 1
+# The position of each sensor in a packed state (two bits each from the least significant end).
+SENSORS = ('lights', 'gpio4', 'gpio5', 'fa3', 'fa4', 'fa5')
+# Where the schema version starts.
+VERSION_SHIFT = 2 * len(SENSORS)
+
+# Two bit codes for the tri-state sensor values.
+UNKNOWN = 0
+OFF = 1
+ON = 2
+_codes = {None: UNKNOWN, False: OFF, True: ON}
+_booleans = {UNKNOWN: None, OFF: False, ON: True, 3: None}
+
+# sensor -> bit offset
+_shifts = dict((key, 2 * i) for i, key in enumerate(SENSORS))
+
+def mask(keys):
+    ''' Return the bits covering the given sensors.
+    @param	keys	Iterable of keys from SENSORS.
+    '''
+    bits = 0
+    for key in keys:
+        bits |= 3 << _shifts[key]
+    return bits
+
+# Masks for Updater's change_detection setting.
+LIGHTS_MASK = mask(('lights',))
+ALL_MASK = mask(SENSORS)
+change_masks = {'lights': LIGHTS_MASK, 'any': ALL_MASK}
+
+def encode(booleans, version=SCHEMA_VERSION):
+    ''' Pack sensor states.
+    @param	booleans	dict of sensor key -> True, False or None. Keys not in SENSORS are ignored.
+    @param	version		Schema version to stamp the state with.
+    @return			The packed state as an int.
+    '''
+    packed = version << VERSION_SHIFT
+    for key, boolean in booleans.iteritems():
+        if key in _shifts:
+            packed |= _codes[boolean] << _shifts[key]
+    return packed
+
+# Every sensor unknown, recorded for the times the bot can't see the sensors.
+NONE_KNOWN = encode({})
+
+def version(packed):
+    ''' Return the schema version of a packed state '''
+    return packed >> VERSION_SHIFT
+
+def value(packed, key):
+    ''' Return the state of one sensor (True, False or None) from a packed state '''
+    return _booleans[(packed >> _shifts[key]) & 3]
+
+def shift(key):
+    ''' Return the bit offset of a sensor's two bits in a packed state '''
+    return _shifts[key]
+
+def code(boolean):
+    ''' Return the two bit code (UNKNOWN, OFF or ON) for True, False or None '''
+    return _codes[boolean]
+
+def decode(packed):
+    ''' Unpack a packed state.
+    @return		dict of sensor key -> True, False or None for every key in SENSORS.
+    '''
+    return dict((key, _booleans[(packed >> shift) & 3]) for key, shift in _shifts.iteritems())
+
+def diff(old, new, bits=ALL_MASK):
+    ''' Return the keys of the sensors that differ between two packed states.
+    @param	old	Packed state.
+    @param	new	Packed state.
+    @param	bits	Mask of the sensors to compare.
+    @return		List of keys in SENSORS order.
+    '''
+    changed = (old ^ new) & bits
+    if not changed:
+        return []
+    return [key for key in SENSORS if changed & (3 << _shifts[key])]
@@ -0,0 +1,219 @@
+__authors__ = ['haxwithaxe <me@haxwithaxe.net>']
+
+__license__ = 'GPLv3'
+
+import Queue
+import sqlite3
+import threading
+import state
+from aggregate import OccupancyAggregates
+from log import debug, info, warn, error, critical, exception
+
+
+# Queued instead of a transition to have the aggregates rebuilt from the transitions.
+REBUILD = 'rebuild'
+
+class HistoryStore(threading.Thread):
+    ''' Append-only log of status transitions in an SQLite database, so history survives restarts.
+    put() only queues a transition, this thread writes them in batches so the poll loop never waits
+    on the disk. Queries open a connection of their own and the database is in WAL mode, so they
+    don't wait on the writer either. Transitions are indexed by the time they were observed.
+    The OccupancyAggregates are kept up to date by the same thread and saved in the same
+    transaction as the transitions they came from.
+    '''
+
+    schema = ('''CREATE TABLE IF NOT EXISTS transitions (
+                id INTEGER PRIMARY KEY,
+                time_changed REAL NOT NULL,
+                time_observed REAL NOT NULL,
+                state INTEGER NOT NULL,
+                digest TEXT)''',
+            'CREATE INDEX IF NOT EXISTS transitions_time_observed ON transitions (time_observed)',
+            '''CREATE TABLE IF NOT EXISTS occupancy (
+                sensor TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                on_s REAL NOT NULL,
+                known_s REAL NOT NULL,
+                PRIMARY KEY (sensor, hour))''',
+            # The latest transition in occupancy, there is only ever one row.
+            '''CREATE TABLE IF NOT EXISTS occupancy_applied (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                time_observed REAL NOT NULL,
+                state INTEGER NOT NULL)''')
+
+    def __init__(self, path, batch=100):
+        '''
+        @param	path	File name of the database, created if it doesn't exist.
+        @param	batch	Most transitions written in one transaction.
+        '''
+        threading.Thread.__init__(self, name='StatusHistoryStore')
+        self.setDaemon(True)
+        self.path = path
+        self.batch = batch
+        # Rows waiting to be written, None tells the thread to stop.
+        self._queue = Queue.Queue()
+        self.stats = {'written': 0, 'batches': 0, 'rebuilds': 0}
+        self.aggregates = OccupancyAggregates()
+        db = self._connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                db.execute(statement)
+            db.commit()
+            self._load_aggregates(db)
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def put(self, time_changed, time_observed, packed, digest=None):
+        ''' Queue a transition to be written.
+        @param	time_changed	The sensor's timestamp of the change in unix seconds (0 if unknown).
+        @param	time_observed	When the change was seen in unix seconds.
+        @param	packed		The packed sensor state.
+        @param	digest		Hex digest of the payload the state came from.
+        '''
+        self._queue.put((time_changed, time_observed, packed, digest))
+
+    def rebuild_aggregates(self):
+        ''' Have the aggregates rebuilt from the stored transitions once everything queued so far is written. '''
+        self._queue.put(REBUILD)
+
+    def run(self):
+        ''' Threaded entry point. Writes queued transitions until close() is called. '''
+        db = self._connect()
+        try:
+            while True:
+                items = [self._queue.get()]
+                # Whatever queued up while the last batch was written goes in the same transaction.
+                while items[-1] is not None and len(items) < self.batch:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                rows = []
+                for item in items:
+                    if isinstance(item, tuple):
+                        rows.append(item)
+                        continue
+                    if rows:
+                        self._write(db, rows)
+                        rows = []
+                    if item is None:
+                        return
+                    self._rebuild_aggregates(db)
+                if rows:
+                    self._write(db, rows)
+        finally:
+            db.close()
+
+    def _write(self, db, rows):
+        try:
+            with db:
+                db.executemany('INSERT INTO transitions (time_changed, time_observed, state, digest) VALUES (?, ?, ?, ?)', rows)
+                for time_changed, time_observed, packed, digest in rows:
+                    self.aggregates.apply(time_observed, packed)
+                self._save_aggregates(db)
+        except sqlite3.Error as e:
+            error('HistoryStore._write: dropped %s transitions: %r', len(rows), e)
+            return
+        self.stats['written'] += len(rows)
+        self.stats['batches'] += 1
+        debug('HistoryStore._write: wrote %s transitions', len(rows))
+
+    def _save_aggregates(self, db):
+        ''' Write the buckets that changed, as part of the caller's transaction '''
+        db.executemany('INSERT OR REPLACE INTO occupancy (sensor, hour, on_s, known_s) VALUES (?, ?, ?, ?)', self.aggregates.pop_dirty())
+        if self.aggregates.last_time is not None:
+            db.execute('INSERT OR REPLACE INTO occupancy_applied (id, time_observed, state) VALUES (0, ?, ?)',
+                    (self.aggregates.last_time, self.aggregates.last_state))
+
+    def _load_aggregates(self, db):
+        ''' Load the saved aggregates, rebuilding them if they're behind the transitions (eg they're new) '''
+        applied = db.execute('SELECT time_observed, state FROM occupancy_applied').fetchall()
+        latest = db.execute('SELECT max(time_observed) FROM transitions').fetchall()[0][0]
+        if applied and applied[0][0] == latest:
+            self.aggregates.load(db.execute('SELECT sensor, hour, on_s, known_s FROM occupancy'), *applied[0])
+            # Only changes from here on need saving.
+            self.aggregates.pop_dirty()
+        elif latest is not None:
+            self._rebuild_aggregates(db)
+
+    def _rebuild_aggregates(self, db):
+        ''' Apply every stored transition to fresh aggregates and save them '''
+        info('HistoryStore: rebuilding the occupancy aggregates')
+        self.aggregates.reset()
+        try:
+            with db:
+                for time_observed, packed in db.execute('SELECT time_observed, state FROM transitions ORDER BY time_observed'):
+                    self.aggregates.apply(time_observed, packed)
+                self._save_aggregates(db)
+        except sqlite3.Error as e:
+            error('HistoryStore._rebuild_aggregates: %r', e)
+            return
+        self.stats['rebuilds'] += 1
+
+    def close(self):
+        ''' Stop the thread once everything queued so far is written. '''
+        self._queue.put(None)
+
+    def _query(self, sql, args=()):
+        db = self._connect()
+        try:
+            return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+    def recent(self, count):
+        ''' Return the latest count transitions as (time_changed, time_observed, state), oldest first '''
+        rows = self._query('SELECT time_changed, time_observed, state FROM transitions ORDER BY time_observed DESC LIMIT ?', (count,))
+        rows.reverse()
+        return rows
+
+    def state_at(self, when):
+        ''' Return the packed state as of a time, or None if nothing was stored before it '''
+        rows = self._query('SELECT state FROM transitions WHERE time_observed <= ? ORDER BY time_observed DESC LIMIT 1', (when,))
+        return rows[0][0] if rows else None
+
+    def on_seconds(self, key, start, end):
+        ''' Return the number of seconds a sensor was on between two times.
+        @param	key	Key of the sensor in state.SENSORS.
+        @param	start	Unix seconds.
+        @param	end	Unix seconds, the latest state counts as lasting until then.
+        @return		(seconds on, seconds the sensor's state was known)
+        '''
+        current = self.state_at(start)
+        since = start
+        on = known = 0.0
+        rows = self._query('SELECT time_observed, state FROM transitions WHERE time_observed > ? AND time_observed < ? ORDER BY time_observed', (start, end))
+        for observed, packed in rows + [(end, None)]:
+            if current is not None:
+                value = state.value(current, key)
+                if value is not None:
+                    known += observed - since
+                if value:
+                    on += observed - since
+            current, since = packed, observed
+        return on, known
+
+    def last_period(self, key, boolean=True):
+        ''' Find the latest period a sensor was in a state.
+        @param	key	Key of the sensor in state.SENSORS.
+        @param	boolean	The state, True for on or False for off.
+        @return		(start, end) unix seconds, end is None if the sensor is still in that state.
+        		None if it has never been seen in it.
+        '''
+        field, code = state.shift(key), state.code(boolean)
+        rows = self._query('SELECT time_observed FROM transitions WHERE (state >> ?) & 3 = ? ORDER BY time_observed DESC LIMIT 1', (field, code))
+        if not rows:
+            return None
+        last = rows[0][0]
+        # Where it got into that state: right after the latest transition before it that wasn't in it.
+        rows = self._query('SELECT time_observed FROM transitions WHERE time_observed < ? AND (state >> ?) & 3 != ? ORDER BY time_observed DESC LIMIT 1', (last, field, code))
+        before = rows[0][0] if rows else None
+        rows = self._query('SELECT min(time_observed) FROM transitions WHERE time_observed > ? AND time_observed <= ?', (before if before is not None else float('-inf'), last))
+        start = rows[0][0]
+        # And where it left it: the transition after the latest one in it.
+        rows = self._query('SELECT min(time_observed) FROM transitions WHERE time_observed > ?', (last,))
+        return start, rows[0][0]
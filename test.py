@@ -1,7 +1,879 @@
 from supybot.test import *
 
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import datetime
+import httplib
+import logging
+import BaseHTTPServer
+import SocketServer
+import supybot.ircmsgs as ircmsgs
+import supybot.registry as registry
+import supybot.world as world
+
+from connection import ConnectionPool, StaleConnectionExceptions
+import plugin
+from update import StatusParser, SingleFlight, Updater, message_formats
+import state
+import history
+from store import HistoryStore
+from schedule import PollScheduler, Ticker
+from aggregate import OccupancyAggregates
+from retry import RetryPolicy, CircuitBreaker
+from debounce import Debouncer
+from outbound import AnnouncementQueue
+from settings import Settings, setting_names
+import bench
+from log import logger
+
+
 class StatusTestCase(PluginTestCase):
     plugins = ('Status',)
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.server = StubServer('date=Monday,_Jan_20_at_12:17_AM\nsubject=Lights=true\nbody=FA3=false\n')
+        self.handler = self.irc.getCallback('Status').status_handler
+        # The tests feed the handler themselves, stop it polling on its own.
+        self.handler.keep_alive = False
+        self.handler.wakeup.set()
+        self.handler.connected.set()
+        self.handler.join(5)
+        self.handler.updater.source = self.server.url
+        # Start from no history at all rather than the unknown recorded at startup.
+        self.handler.history = history.StatusHistory()
+        self.handler.store.close()
+        self.handler.store = HistoryStore(conf.supybot.directories.data.dirize('commands.db'))
+        self.handler.store.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        PluginTestCase.tearDown(self)
+
+    def record(self, observed, **booleans):
+        ''' Add a transition to the history and the store as if it had been polled '''
+        packed = state.encode(booleans) if booleans else state.NONE_KNOWN
+        self.handler.history.append(0, observed, packed)
+        self.handler.store.put(0, observed, packed)
+
+    def wait_for_store(self, count):
+        for i in range(50):
+            if self.handler.store.stats['written'] >= count:
+                return
+            time.sleep(0.1)
+        self.fail('The store only wrote %s transitions' % self.handler.store.stats['written'])
+
+    def testLiveFormats(self):
+        self.handler.updater.get_status()
+        self.assertRegexp('status json', '"lights": true')
+        self.assertRegexp('status uptime', 'Polling for')
+
+    def testStaleWhileRevalidate(self):
+        # Fetched an hour ago, past the default max_status_age of 30 minutes.
+        self.handler.snapshot = plugin.StatusSnapshot('HacDC was open an hour ago', 'human', 'raw', time.time() - 3600)
+        self.assertFalse(self.handler.updater.time_fetched)
+        self.assertResponse('status', 'HacDC was open an hour ago (as of 60 min ago)')
+        # The stale reply started a refresh from the source.
+        self.handler._refresh_thread.join(5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertNotEqual(self.handler.snapshot.default, 'HacDC was open an hour ago')
+        # Now it's fresh, answered as is and without fetching again.
+        self.assertResponse('status', self.handler.snapshot.default)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testHistory(self):
+        self.assertResponse('status history', 'No changes seen yet.')
+        now = time.time()
+        self.record(now - 7200, lights=False, fa3=False)
+        self.record(now - 3600, lights=True, fa3=True)
+        self.record(now - 60)
+        self.assertRegexp('status history', r'^\S+ \w+ \d+ \w+: unknown; \S+ \w+ \d+ \w+: open, hall light: off -> on; \S+ \w+ \d+ \w+: closed$')
+        self.assertRegexp('status history 1', ': unknown$')
+        self.assertRegexp('status since 90m', ': open.*: unknown|: unknown.*: open')
+        self.assertNotRegexp('status since 90m', 'closed')
+        self.assertResponse('status since 1m', 'No changes since then.')
+        self.assertRegexp('status since whenever', 'since takes a time')
+
+    def testStoreFormats(self):
+        self.assertResponse('status last', 'The space has not been open since the history began.')
+        now = time.time()
+        self.record(now - 7200, lights=False)
+        self.record(now - 3600, lights=True)
+        self.record(now - 1800)
+        self.wait_for_store(3)
+        # Known for 5400 seconds of the last 3 hours, open for 1800 of them.
+        self.assertRegexp('status open 3h', r'^Open 0\.5 hours since .* \(33% of the time the status is known\)\.$')
+        self.assertRegexp('status last', '^The space was last open from .* to ')
+        self.assertRegexp('status last closed', '^The space was last closed from ')
+        self.assertRegexp('status last nonsense', '^last takes a sensor')
+        self.assertRegexp('status hours', r'^Usually open: \w+ \d+[AP]M-\d+[AP]M')
+        self.assertResponse('status hours fa3', 'Not enough history yet.')
+
+
+class DebugLogTestCase(SupyTestCase):
+    ''' Runs with the plugin's debug messages on, so they're formatted by the real supybot.log '''
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.level = logger.level
+        logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        logger.setLevel(self.level)
+        SupyTestCase.tearDown(self)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves the stub server's payload over HTTP/1.1 keep-alive '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.path != '/OccSensor.txt':
+            # /moved goes to the payload, /ftp off the web and anything else redirects to itself.
+            self.send_response(302)
+            self.send_header('Location', {'/moved': '/OccSensor.txt', '/ftp': 'ftp://127.0.0.1/OccSensor.txt'}.get(self.path, self.path))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.server.requests.append(self.headers)
+        if self.server.etag and self.headers.getheader('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            return
+        body = self.server.payload
+        self.send_response(200)
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' Local http server that remembers every connection made to it '''
+    daemon_threads = True
+
+    def __init__(self, payload):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.payload = payload
+        # Seconds to sit on each request before answering.
+        self.delay = 0
+        # Sent with the payload and answered with a 304 when it comes back, None for neither.
+        self.etag = None
+        self.connections = []
+        # The headers of every request for the payload.
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/OccSensor.txt' % self.server_port
+
+    def drop_connections(self):
+        ''' Reset every open connection like an idle timeout on the server would '''
+        for conn in self.connections:
+            conn.shutdown(socket.SHUT_RDWR)
+
+
+class ConnectionPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = StubServer('subject=Lights=true\n')
+        self.pool = ConnectionPool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        SupyTestCase.tearDown(self)
+
+    def testReusesConnection(self):
+        for i in range(3):
+            reply = self.pool.get(self.server.url)
+            self.assertEqual(reply.status, 200)
+            self.assertEqual(reply.body, 'subject=Lights=true\n')
+        self.assertEqual(len(self.server.connections), 1)
+
+    def testReconnectsAfterReset(self):
+        self.pool.get(self.server.url)
+        self.server.drop_connections()
+        reply = self.pool.get(self.server.url)
+        self.assertEqual(reply.body, 'subject=Lights=true\n')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def testCachesAddress(self):
+        now = [0]
+        self.pool.resolver.clock = lambda: now[0]
+        self.pool.resolver.ttl = 60
+        self.pool.get(self.server.url)
+        cached = self.pool.resolver._addresses.values()[0]
+        self.assertEqual(cached[0], 60)
+        now[0] = 61
+        self.server.drop_connections()
+        self.pool.get(self.server.url)
+        self.assertEqual(self.pool.resolver._addresses.values()[0][0], 121)
+
+    def testFollowsRedirects(self):
+        reply = self.pool.get(self.server.url.replace('OccSensor.txt', 'moved'))
+        self.assertEqual((reply.status, reply.body), (200, 'subject=Lights=true\n'))
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertRaises(httplib.HTTPException, self.pool.get, self.server.url.replace('OccSensor.txt', 'loop'))
+        self.assertRaises(httplib.HTTPException, self.pool.get, self.server.url.replace('OccSensor.txt', 'ftp'))
+
+    def testConditionalRequests(self):
+        self.server.etag = '"1"'
+        updater = Updater(source_url=self.server.url)
+        self.assertTrue(updater.get_status())
+        self.assertEqual(self.server.requests[0].getheader('If-None-Match'), None)
+        self.assertFalse(updater.get_status())
+        self.assertEqual(self.server.requests[1].getheader('If-None-Match'), '"1"')
+        # A new validator for the same bytes isn't parsed again either.
+        self.server.etag = '"2"'
+        self.assertFalse(updater.get_status())
+        self.assertEqual(updater.stats['fetched'], 2)
+        self.assertEqual((updater.stats['not_modified'], updater.stats['unchanged'], updater.stats['parsed']), (1, 1, 1))
+        updater.pool.close()
+
+    def testAbortCutsRequestShort(self):
+        self.pool.get(self.server.url)
+        self.server.delay = 5
+        errors = []
+        def get():
+            try:
+                self.pool.get(self.server.url)
+            except StaleConnectionExceptions as e:
+                errors.append(e)
+        thread = threading.Thread(target=get)
+        thread.start()
+        time.sleep(0.2)
+        self.pool.abort()
+        thread.join(1)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(len(errors), 1)
+        self.assertRaises(socket.error, self.pool.get, self.server.url)
+
+
+class StatusParserTestCase(SupyTestCase):
+    payloads = bench.sample_payloads[:20] + [
+        'date=Monday,_Jan_20_at_12:17_AM\nsubject=Lights=false\nbody=FA3=false;FA4=false;FA5=false',
+        ' Date = Monday,_Jan_20_at_12:17_AM \r\nSUBJECT= lights = ON\r\nbody=fa3=TRUE ; FA4 =true;;fa5=maybe;gpio4=false\r\n',
+        'date=not a date\nsubject=Lights\nbody=\nnoise',
+        ]
+
+    def _parse(self, method, payload):
+        parser = StatusParser()
+        getattr(parser, method)(payload)
+        return (parser.last_changed_date,
+                sorted((k, v.boolean) for k, v in parser.sensor_info.items()),
+                sorted((k, v.boolean) for k, v in parser.subject_info.items()))
+
+    def testSinglePassMatchesSplit(self):
+        for payload in self.payloads:
+            self.assertEqual(self._parse('parse_status', payload), self._parse('parse_status_split', payload))
+
+    def testSinglePassFields(self):
+        date, body, subject = self._parse('parse_status', self.payloads[-2])
+        self.assertEqual((date.month, date.day, date.hour), (1, 20, 0))
+        self.assertEqual(dict(body), {'fa3': True, 'fa4': None, 'fa5': None, 'gpio4': False, 'gpio5': None})
+        self.assertEqual(dict(subject), {'lights': True})
+
+    def testRenderErrorsArentMissingFormats(self):
+        status = StatusParser().get_status(self.payloads[-3])
+        self.assertEqual(status.message.get('nonexistent', 'fallback'), 'fallback')
+        def broken(status):
+            return {}['bug']
+        message_formats['broken'] = broken
+        try:
+            self.assertRaises(KeyError, status.message.get, 'broken')
+        finally:
+            del message_formats['broken']
+
+    def testStatusesDontShareSensors(self):
+        first = StatusParser().get_status(self.payloads[-3])
+        second = StatusParser().get_status(self.payloads[-2])
+        self.assertEqual(first.info['lights'].boolean, False)
+        self.assertEqual(second.info['lights'].boolean, True)
+        self.assertNotEqual(first, second)
+        self.assertEqual(StatusParser._subject_sensors['lights'].boolean, None)
+
+
+class SingleFlightTestCase(SupyTestCase):
+    def share(self, function):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        def call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return function()
+        results = []
+        def caller():
+            try:
+                results.append(flight.do(call))
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=caller) for i in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Give the others time to join the call in flight.
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        return results
+
+    def testSharesResult(self):
+        results = self.share(object)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def testSharesException(self):
+        results = self.share(lambda: {}['missing'])
+        self.assertTrue(isinstance(results[0], KeyError))
+        self.assertEqual(len(set(map(id, results))), 1)
+
+
+class StateTestCase(SupyTestCase):
+    def testRoundTrip(self):
+        booleans = {'lights': True, 'gpio4': None, 'gpio5': None, 'fa3': False, 'fa4': True, 'fa5': None}
+        packed = state.encode(booleans)
+        self.assertEqual(state.decode(packed), booleans)
+        self.assertEqual(state.version(packed), state.SCHEMA_VERSION)
+
+    def testDiff(self):
+        old = state.encode({'lights': True, 'fa3': False, 'fa4': True})
+        new = state.encode({'lights': True, 'fa3': True, 'fa4': True})
+        self.assertEqual(state.diff(old, new), ['fa3'])
+        self.assertEqual(state.diff(old, new, state.LIGHTS_MASK), [])
+
+
+class TickerTestCase(DebugLogTestCase):
+    def testSkipsMissedTicks(self):
+        now = [100.0]
+        ticker = Ticker(clock=lambda: now[0])
+        ticker.start()
+        now[0] = 101.0
+        self.assertEqual(ticker.advance(5), 4.0)
+        now[0] = 105.5
+        ticker.start()
+        self.assertEqual(ticker.lag, 0.5)
+        # A slow poll runs past the next two deadlines (110 and 115).
+        now[0] = 117.0
+        self.assertEqual(ticker.advance(5), 3.0)
+        self.assertEqual(ticker.skipped, 2)
+        now[0] = 120.25
+        ticker.start()
+        self.assertEqual(ticker.stats, {'ticks': 3, 'skipped_ticks': 2, 'lag_s': 0.25, 'max_lag_s': 0.5})
+
+
+class PollSchedulerTestCase(SupyTestCase):
+    def testBackoff(self):
+        scheduler = PollScheduler(3, 20, backoff=2.0)
+        quiet = datetime.datetime(2013, 5, 5, 4)
+        intervals = []
+        for i in range(4):
+            scheduler.unchanged()
+            intervals.append(scheduler.next_interval(quiet))
+        self.assertEqual(intervals, [6, 12, 20, 20])
+        scheduler.changed()
+        self.assertEqual(scheduler.next_interval(quiet), 3)
+
+    def testBusyHours(self):
+        scheduler = PollScheduler(3, 60, backoff=2.0)
+        for i in range(PollScheduler.profile_min_samples):
+            scheduler.changed(now=datetime.datetime(2013, 5, 5, 19, i))
+        # Sensor only changes don't count.
+        scheduler.changed(learn=False)
+        for i in range(10):
+            scheduler.unchanged()
+        self.assertEqual(scheduler.next_interval(datetime.datetime(2013, 5, 6, 4)), 60)
+        # In the busy hour and the hour before it.
+        self.assertEqual(scheduler.next_interval(datetime.datetime(2013, 5, 6, 19, 30)), 3)
+        self.assertEqual(scheduler.next_interval(datetime.datetime(2013, 5, 6, 18, 30)), 3)
+        self.assertEqual(scheduler.next_interval(datetime.datetime(2013, 5, 6, 20, 30)), 60)
+
+    def testLearnsLocalTime(self):
+        scheduler = PollScheduler(3, 60)
+        before = datetime.datetime.now().hour
+        scheduler.changed()
+        after = datetime.datetime.now().hour
+        # The hour next_interval() would see, whatever time the sensor reports.
+        self.assertEqual(sum(scheduler.profile), 1)
+        self.assertTrue(scheduler.profile[before] or scheduler.profile[after])
+
+
+class StatusHistoryTestCase(SupyTestCase):
+    def testRingBuffer(self):
+        buf = history.StatusHistory(size=4)
+        for i in range(6):
+            self.assertTrue(buf.append(0, 10 * i, i))
+        # The same state again isn't a transition.
+        self.assertFalse(buf.append(0, 60, 5))
+        self.assertEqual(len(buf), 4)
+        self.assertEqual([entry.state for entry in buf.entries()], [2, 3, 4, 5])
+        self.assertEqual([entry.state for entry in buf.last(2)], [4, 5])
+        self.assertEqual(buf.bisect(35), 2)
+        self.assertEqual([entry.state for entry in buf.since(30)], [3, 4, 5])
+        self.assertEqual(buf.state_at(45), 4)
+        self.assertEqual(buf.state_at(10), None)
+
+    def testParseTime(self):
+        self.assertEqual(history.parse_time('3h', now=10000), 10000 - 3 * 3600)
+        self.assertEqual(history.parse_time('2 days ago', now=200000), 200000 - 2 * 86400)
+        self.assertEqual(history.parse_time('1367712000'), 1367712000)
+        self.assertRaises(ValueError, history.parse_time, 'yesterday')
+
+
+class HistoryStoreTestCase(DebugLogTestCase):
+    def setUp(self):
+        DebugLogTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.store = HistoryStore(os.path.join(self.directory, 'history.db'))
+        self.store.start()
+        closed, open_ = state.encode({'lights': False}), state.encode({'lights': True})
+        for observed, packed in ((100, closed), (200, open_), (300, closed), (400, open_)):
+            self.store.put(0, observed, packed)
+        self.store.close()
+        self.store.join(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        DebugLogTestCase.tearDown(self)
+
+    def testWritesEverything(self):
+        self.assertEqual(self.store.stats['written'], 4)
+        self.assertEqual([row[1] for row in self.store.recent(3)], [200, 300, 400])
+
+    def testOnSeconds(self):
+        self.assertEqual(self.store.on_seconds('lights', 150, 450), (150, 300))
+        self.assertEqual(self.store.on_seconds('lights', 0, 100), (0, 0))
+
+    def testLogsDroppedWrites(self):
+        store = HistoryStore(os.path.join(self.directory, 'broken.db'))
+        db = store._connect()
+        db.execute('DROP TABLE transitions')
+        db.close()
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger.addHandler(handler)
+        try:
+            store.start()
+            store.put(0, 100, state.NONE_KNOWN)
+            store.close()
+            store.join(5)
+        finally:
+            logger.removeHandler(handler)
+        self.assertTrue([message for message in messages if 'dropped 1 transitions' in message and 'no such table' in message])
+
+    def testUnknownSpansDontCount(self):
+        store = HistoryStore(os.path.join(self.directory, 'gaps.db'))
+        store.start()
+        # The bot stopped at 500 with the lights on and came back at 1000.
+        for observed, packed in ((400, state.encode({'lights': True})), (500, state.NONE_KNOWN), (1000, state.encode({'lights': True}))):
+            store.put(0, observed, packed)
+        store.close()
+        store.join(5)
+        self.assertEqual(store.on_seconds('lights', 400, 1100), (200, 200))
+        self.assertEqual(sum(store.aggregates.known['lights']), 100)
+        self.assertEqual(store.last_period('lights', True), (1000, None))
+
+    def testAggregatesFollowWrites(self):
+        ratios = self.store.aggregates.ratios('lights')
+        self.assertEqual(len([ratio for ratio in ratios if ratio is not None]), 1)
+        # Saved along with the transitions, so a new store loads them rather than rebuilding.
+        store = HistoryStore(self.store.path)
+        self.assertEqual(store.aggregates.ratios('lights'), ratios)
+        self.assertEqual(store.stats['rebuilds'], 0)
+
+    def testLastPeriod(self):
+        self.assertEqual(self.store.last_period('lights', True), (400, None))
+        self.assertEqual(self.store.last_period('lights', False), (300, 400))
+        self.assertEqual(self.store.last_period('fa3', True), None)
+
+
+class OccupancyAggregatesTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # Midnight at the start of a Monday, local time.
+        self.monday = time.mktime((2013, 5, 6, 0, 0, 0, 0, 0, -1))
+        self.open = state.encode({'lights': True})
+        self.closed = state.encode({'lights': False})
+
+    def testHoursOfTheWeek(self):
+        aggregates = OccupancyAggregates()
+        aggregates.apply(self.monday + 18 * 3600, self.closed)
+        aggregates.apply(self.monday + 19 * 3600 + 1800, self.open)
+        aggregates.apply(self.monday + 21 * 3600, self.closed)
+        aggregates.apply(self.monday + 22 * 3600, self.closed)
+        ratios = aggregates.ratios('lights')
+        self.assertEqual(ratios[17], None)
+        self.assertEqual(ratios[18:22], [0.0, 0.5, 1.0, 0.0])
+        self.assertEqual(ratios[22], None)
+        self.assertEqual(ratios[:17], [None] * 17)
+
+    def testWholeWeeks(self):
+        aggregates = OccupancyAggregates()
+        aggregates.apply(self.monday, self.open)
+        aggregates.apply(self.monday + 14 * 24 * 3600 + 3600, self.closed)
+        self.assertEqual(aggregates.known['lights'][0], 3 * 3600)
+        self.assertEqual(aggregates.known['lights'][1], 2 * 3600)
+        self.assertEqual(set(aggregates.ratios('lights')), set([1.0]))
+
+
+class RetryTestCase(DebugLogTestCase):
+    def setUp(self):
+        DebugLogTestCase.setUp(self)
+        self.now = [0.0]
+        self.sleeps = []
+        self.calls = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now[0] += seconds
+
+    def policy(self, **kwargs):
+        policy = RetryPolicy(clock=lambda: self.now[0], sleep=self.sleep, **kwargs)
+        # No jitter, so the waits are predictable.
+        policy.backoff = lambda attempt: min(policy.cap, policy.base * 2 ** attempt)
+        return policy
+
+    def failing(self, failures):
+        def function():
+            self.calls.append(self.now[0])
+            if len(self.calls) <= failures:
+                raise socket.error('down')
+            return 'up'
+        return function
+
+    def testRetriesUntilItWorks(self):
+        policy = self.policy(attempts=3, base=1.0, cap=10.0, deadline=30.0)
+        self.assertEqual(policy.call(self.failing(2), (socket.error,)), 'up')
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+
+    def testAttemptLimit(self):
+        policy = self.policy(attempts=3, base=1.0, cap=10.0, deadline=30.0)
+        self.assertRaises(socket.error, policy.call, self.failing(5), (socket.error,))
+        self.assertEqual(len(self.calls), 3)
+
+    def testDeadline(self):
+        policy = self.policy(attempts=10, base=4.0, cap=10.0, deadline=20.0)
+        self.assertRaises(socket.error, policy.call, self.failing(10), (socket.error,))
+        # Waits of 4 and 8, another 10 would go past the deadline.
+        self.assertEqual(self.calls, [0.0, 4.0, 12.0])
+
+    def testOtherExceptionsArentRetried(self):
+        policy = self.policy()
+        self.assertRaises(socket.error, policy.call, self.failing(1), (ValueError,))
+        self.assertEqual(len(self.calls), 1)
+
+
+class CircuitBreakerTestCase(DebugLogTestCase):
+    def setUp(self):
+        DebugLogTestCase.setUp(self)
+        self.now = [0.0]
+        self.breaker = CircuitBreaker(threshold=3, reset_timeout=60.0, clock=lambda: self.now[0])
+
+    def testOpensAndRecovers(self):
+        breaker = self.breaker
+        for i in range(2):
+            breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.now[0] = 60.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only the one probe.
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def testFailedProbeReopens(self):
+        breaker = self.breaker
+        for i in range(3):
+            breaker.failure()
+        self.now[0] = 60.0
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.now[0] = 100.0
+        self.assertFalse(breaker.allow())
+        self.now[0] = 120.0
+        self.assertTrue(breaker.allow())
+
+    def testSuccessResetsCount(self):
+        breaker = self.breaker
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class DebouncerTestCase(SupyTestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.debouncer = Debouncer(settle=10, min_dwell=60, max_hold=120, clock=lambda: self.now[0])
+
+    def status(self, lights, fa3=False):
+        return StatusParser().get_status('date=Monday,_Jan_20_at_12:17_AM\nsubject=Lights=%s\nbody=FA3=%s' % (lights, fa3))
+
+    def testSettleAndDwell(self):
+        debouncer = self.debouncer
+        self.assertEqual(debouncer.due(), None)
+        closed, opened = self.status(False), self.status(True)
+        debouncer.offer(closed)
+        self.assertEqual(debouncer.due(), 10)
+        self.assertEqual(debouncer.release(), None)
+        self.now[0] = 10
+        self.assertEqual(debouncer.release(), (None, closed))
+        self.now[0] = 20
+        debouncer.offer(opened)
+        # Settled at 30 but the last announcement was at 10.
+        self.assertEqual(debouncer.due(), 50)
+        self.now[0] = 70
+        self.assertEqual(debouncer.release(), (closed, opened))
+        self.assertEqual(debouncer.stats, {'announced': 2, 'suppressed': 0})
+
+    def testFlapCollapses(self):
+        debouncer = self.debouncer
+        debouncer.offer(self.status(False))
+        self.now[0] = 10
+        debouncer.release()
+        self.now[0] = 100
+        # A -> B -> A says nothing at all.
+        debouncer.offer(self.status(True))
+        self.now[0] = 101
+        debouncer.offer(self.status(False))
+        self.now[0] = 200
+        self.assertEqual(debouncer.release(), None)
+        self.assertEqual(debouncer.due(), None)
+        self.assertEqual(debouncer.stats, {'announced': 1, 'suppressed': 2})
+
+    def testMaxHold(self):
+        debouncer = self.debouncer
+        for i in range(24):
+            self.now[0] = 5 * i
+            debouncer.offer(self.status(i % 2 == 0))
+        # Never settled, but it's been held back long enough.
+        self.assertEqual(debouncer.due(), 5)
+        self.now[0] = 120
+        self.assertEqual(debouncer.release()[1].state, self.status(False).state)
+
+    def testOnlySubscribedChangesRestartSettle(self):
+        debouncer = self.debouncer
+        debouncer.offer(self.status(True))
+        self.now[0] = 5
+        debouncer.offer(self.status(True, fa3=True), state.LIGHTS_MASK)
+        self.assertEqual(debouncer.due(), 5)
+        debouncer.offer(self.status(False, fa3=True), state.LIGHTS_MASK)
+        self.assertEqual(debouncer.due(), 10)
+
+
+class AnnouncementQueueTestCase(SupyTestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.queue = AnnouncementQueue(rate=1.0, burst=1, clock=lambda: self.now[0])
+        self.irc = object()
+
+    def build(self, channel, previous, status):
+        if previous == status:
+            return None
+        return ircmsgs.privmsg(channel, '%s -> %s' % (previous, status))
+
+    def testCoalescesPerChannel(self):
+        queue, irc = self.queue, self.irc
+        queue.put(irc, '#a', None, 'closed', self.build)
+        queue.put(irc, '#b', None, 'closed', self.build)
+        queue.put(irc, '#a', 'closed', 'open', self.build)
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.stats['coalesced'], 1)
+        self.assertEqual(queue._next()[1].args, ('#b', 'None -> closed'))
+        # The burst is used up, the next one waits for a token.
+        self.assertEqual(queue._next(), 1.0)
+        self.now[0] = 1.0
+        # Built against what #a last heard, so nothing in between is lost.
+        self.assertEqual(queue._next()[1].args, ('#a', 'None -> open'))
+
+    def testSurvivesDeliveryErrors(self):
+        class Broken:
+            def queueMsg(self, msg):
+                raise ValueError('gone')
+        delivered = threading.Event()
+        class Working:
+            def queueMsg(self, msg):
+                delivered.set()
+        queue = AnnouncementQueue(rate=10, burst=10)
+        queue.start()
+        try:
+            queue.put(Broken(), '#a', None, 'open', self.build)
+            queue.put(Working(), '#a', None, 'open', self.build)
+            self.assertTrue(delivered.wait(5))
+            self.assertTrue(queue.is_alive())
+        finally:
+            queue.close()
+            queue.join(5)
+
+    def testDropsWhatChangedBack(self):
+        queue, irc = self.queue, self.irc
+        queue.put(irc, '#a', None, 'closed', self.build)
+        self.assertEqual(queue._next()[1].args, ('#a', 'None -> closed'))
+        queue.put(irc, '#a', 'closed', 'open', self.build)
+        queue.put(irc, '#a', 'open', 'closed', self.build)
+        self.now[0] = 1.0
+        self.assertEqual(queue._next(), None)
+        self.assertEqual(queue.stats['unchanged'], 1)
+        # And it didn't use up a token.
+        queue.put(irc, '#a', 'closed', 'open', self.build)
+        self.assertEqual(queue._next()[1].args, ('#a', 'closed -> open'))
+
+
+class FanOutTestCase(SupyTestCase):
+    class Irc:
+        def __init__(self, *channels):
+            self.state = self
+            self.channels = dict.fromkeys(channels)
+            self.sent = []
+
+        def queueMsg(self, msg):
+            self.sent.append(msg)
+
+    class Settings:
+        class current:
+            use_notice = False
+            quiet_channels = frozenset(['#quiet'])
+
+        def sensors(self, channel):
+            return channel == '#fa3' and ('fa3',) or ('lights',)
+
+    class Updater:
+        change_mask = state.LIGHTS_MASK
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.ircs = world.ircs[:]
+        self.first, self.second = self.Irc('#a', '#quiet'), self.Irc('#b', '#fa3')
+        world.ircs[:] = [self.first, self.second]
+        self.handler = plugin.StatusHandler()
+        self.handler.settings = self.Settings()
+        self.handler.updater = self.Updater()
+        self.handler.outbound = AnnouncementQueue(rate=10, burst=10)
+
+    def tearDown(self):
+        world.ircs[:] = self.ircs
+        SupyTestCase.tearDown(self)
+
+    def deliver(self):
+        while True:
+            item = self.handler.outbound._next()
+            if not isinstance(item, tuple):
+                return
+            irc, msg, queued = item
+            irc.queueMsg(msg)
+
+    def testEachNetworkGetsItsOwn(self):
+        parser = StatusParser()
+        closed = parser.get_status('date=Monday,_Jan_20_at_12:17_AM\nsubject=Lights=false\nbody=FA3=false')
+        opened = parser.get_status('date=Monday,_Jan_20_at_12:30_AM\nsubject=Lights=true\nbody=FA3=false')
+        self.handler._notify_channels(None, closed)
+        self.deliver()
+        self.handler._notify_channels(closed, opened)
+        self.deliver()
+        self.assertEqual([msg.args[0] for msg in self.first.sent], ['#a', '#a'])
+        self.assertEqual([msg.args[0] for msg in self.second.sent], ['#b', '#b'])
+        self.assertEqual(self.first.sent[-1].args[1], opened.message['default'])
+        # #fa3 only hears about fa3, which hasn't changed.
+        self.assertEqual(self.handler.outbound.stats['unchanged'], 2)
+
+    def testSensorChangeWithLightsUnknown(self):
+        parser = StatusParser()
+        before = parser.get_status('date=Monday,_Jan_20_at_12:17_AM\nsubject=\nbody=GPIO4=false')
+        after = parser.get_status('date=Monday,_Jan_20_at_12:30_AM\nsubject=\nbody=GPIO4=true')
+        self.assertEqual(after.message['default'], None)
+        # What run() does with a sensor-only change.
+        self.handler._update_snapshot(after.message)
+        self.assertEqual(self.handler.snapshot.default, plugin.no_status_message)
+        self.assertEqual(self.handler._channel_text(('lights', 'gpio4'), before, after), 'gpio4: off -> on')
+        self.assertEqual(self.handler._channel_text(('lights',), None, after), None)
+
+
+class SettingsTestCase(SupyTestCase):
+    def setUp(self):
+        self.values = dict((name, registry.Integer(1, '')) for name in setting_names)
+        self.values['quiet_channels'] = registry.SpaceSeparatedListOfStrings(['#quiet'], '')
+        self.values['sensors'] = registry.SpaceSeparatedListOfStrings(['lights'], '')
+        self.reads = []
+        self.settings = Settings(self.registryValue)
+
+    def registryValue(self, name, channel=None, value=True):
+        if not value:
+            return self.values[name]
+        self.reads.append(name)
+        return self.values[name]()
+
+    def testReadsOnce(self):
+        self.assertEqual(self.settings.current.interval, 1)
+        reads = len(self.reads)
+        self.assertTrue('#quiet' in self.settings.current.quiet_channels)
+        self.assertEqual(self.settings.sensors('#a'), ('lights',))
+        self.assertEqual(self.settings.sensors('#a'), ('lights',))
+        self.assertEqual(self.reads[reads:], ['sensors'])
+
+    def testRereadsAfterChange(self):
+        self.assertEqual(self.settings.current.interval, 1)
+        self.values['interval'].setValue(5)
+        self.assertEqual(self.settings.current.interval, 5)
+        self.values['sensors'].setValue(['lights', 'fa3'])
+        self.assertEqual(self.settings.sensors('#a'), ('lights', 'fa3'))
+
+    def testCloseUnhooks(self):
+        self.assertEqual(self.settings.current.interval, 1)
+        self.settings.close()
+        # Changes don't reach a closed instance any more.
+        self.values['interval'].setValue(5)
+        self.assertEqual(self.settings.current.interval, 1)
+
+    def testWithoutCallbacks(self):
+        # Stock Supybot registry values have no addCallback.
+        class Value(object):
+            def __init__(self, value):
+                self.value = value
+            def __call__(self):
+                return self.value
+        self.values = dict((name, Value(1)) for name in setting_names)
+        self.values['quiet_channels'] = Value(['#quiet'])
+        self.values['sensors'] = Value(['lights'])
+        now = [0.0]
+        settings = Settings(self.registryValue, clock=lambda: now[0])
+        self.assertEqual(settings.current.interval, 1)
+        self.values['interval'].value = 5
+        self.assertEqual(settings.current.interval, 1)
+        now[0] = Settings.refresh
+        self.assertEqual(settings.current.interval, 5)
+        settings.close()
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
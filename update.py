@@ -3,17 +3,28 @@ __authors__ = ['haxwithaxe <me@haxwithaxe.net>']
 __license__ = 'GPLv3'
 
 import json
+import collections
+import re
 import time
+import hashlib
+import threading
 import _strptime # required to avoid import errors
 import datetime
 import sys
-import urllib2
+import socket
+import httplib
 import include
+import state
+from connection import ConnectionPool
+from retry import RetryPolicy, CircuitBreaker
 from include import StatusPluginException
-from log import debug, info, warn, error, critical, exception
+from log import debug, debug_enabled, info, warn, error, critical, exception
 
 conf = {'source_url': None}
 
+# Exceptions from a single request that are worth retrying
+FetchExceptions = (socket.error, httplib.HTTPException, StatusPluginException)
+
 def set_TZ(tz='GMT'):
     os.environ['TZ'] = tz
     time.tzset()
@@ -26,6 +37,48 @@ def set_EDT():
     ''' Set the current timezone to EST/EDT '''
     set_TZ('US/Eastern')
 
+class SingleFlight:
+    ''' Let concurrent calls share a single call in flight and its result (or exception) '''
+
+    class _Call:
+	''' A call in flight '''
+	def __init__(self):
+	    self.done = threading.Event()
+	    self.result = None
+	    self.exc_info = None
+
+    def __init__(self):
+	self._lock = threading.Lock()
+	# The _Call in flight, if any
+	self._call = None
+
+    def do(self, function):
+	''' Call function, or if another thread already is, wait for it and share its result.
+	@param	function	Callable taking no arguments.
+	@return			The result of the call.
+	'''
+	with self._lock:
+	    call = self._call
+	    leader = call is None
+	    if leader:
+		call = self._call = self._Call()
+	if not leader:
+	    call.done.wait()
+	    if call.exc_info:
+		raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+	    return call.result
+	try:
+	    call.result = function()
+	except:
+	    call.exc_info = sys.exc_info()
+	    raise
+	finally:
+	    with self._lock:
+		self._call = None
+	    call.done.set()
+	return call.result
+
+
 class Updater:
     ''' Update the bot from a remote status source '''
 
@@ -37,14 +90,39 @@ class Updater:
         self.source = conf.get('source_url') or self.__missing_url_config()
 	# The number of seconds to sleep at the end of each loop
         self.interval_s = conf.get('interval_s')
-	# socket timeout in seconds
-	self.timeout = 30
+	# The sensors a change of which makes a new status ('lights' or 'any')
+	self.change_mask = state.change_masks[conf.get('change_detection') or 'lights']
+	# socket timeout in seconds (per attempt)
+	self.timeout = 10
+	# Keep-alive connections to the source (reused between polls)
+	self.pool = ConnectionPool(self.timeout)
+	# Retries for a single fetch, bounded to 30 seconds in all
+	self.retry = RetryPolicy(attempts=3, base=1.0, cap=10.0, deadline=30.0)
+	# Stops fetching from a dead source and probes it once a minute instead
+	self.breaker = CircuitBreaker(threshold=5, reset_timeout=60.0)
 	# The Status retrived before the most recent Status
         self.last_status = None
 	# The most recent Status retrived
         self.status = None
 	# Token indicating if this is the first time through the loop
         self._first_run = True
+	# Token indicating a new status has been fetched but check() hasn't returned it yet
+	self._changed = False
+	# ChangeEvents fetched but not yet taken by pop_events()
+	self._events = []
+	# Guards status, last_status, _changed and _first_run
+	self._lock = threading.Lock()
+	# Shares one fetch between threads calling get_status() at the same time
+	self._flight = SingleFlight()
+	# Cache validators from the last full reply, sent back as a conditional request
+	self.etag = None
+	self.last_modified = None
+	# Digest of the last payload parsed, identical payloads are not parsed again
+	self.digest = None
+	# Unix timestamp of the last time the source answered (even if nothing changed)
+	self.time_fetched = 0
+	# Counters for the poll loop (see the 'sensordata stats' command)
+	self.stats = {'fetched': 0, 'not_modified': 0, 'unchanged': 0, 'parsed': 0, 'failed': 0, 'short_circuited': 0}
 
     def __missing_url_config(self):
 	''' freak out if there is no url to get data from '''
@@ -54,59 +132,134 @@ class Updater:
         ''' Get the latest status, test if it's new, update the bot if it is, and sleep so we don't go too fast. 
         return None if no change or self.status.message if there is a new status
         '''
-	info('Updater.check: checking')
-	# get the Status for the latest sensor upload
+	debug('Updater.check: checking')
+	# get the Status for the latest sensor upload (or share one another thread is getting)
         self.get_status()
-        debug('Updater.check: self.status:', repr(self.status), '\nself.last_status:', repr(self.last_status))
-	# Test if the Status is a newer status than the last one fetched
-        if self.is_new_status():
+	with self._lock:
+	    # Whoever fetched it, a new status is only announced once and only from here.
+	    changed, self._changed = self._changed, False
+	    if not changed and self._first_run and self.status:
+		# still announce the state we started up with
+		self._first_run = False
+		changed = True
+	    status = self.status
+	if changed:
             info('Updater.check: new status')
 	    # if it is then return the messages for use by the bot
-            return self.status.message
+            return status.message
 	debug('Updater.check: old status')
         return None
 
+    def pop_events(self):
+	''' Return the ChangeEvents since the last call (oldest first) and forget them. '''
+	with self._lock:
+	    events, self._events = self._events, []
+	return events
+
     def get_status(self):
         ''' Grab the status from the sensor
 	Sets self.last_status and  self.status
+	Concurrent callers share a single fetch and its result.
+	@return			True if a new Status was parsed, otherwise False (not modified, same payload
+				as last time or no reply).
 	'''
-        parser = StatusParser()	# get a new parser
+	return self._flight.do(self._get_status)
+
+    def _get_status(self):
+	''' Body of get_status(), only ever run by one thread at a time. '''
 	status_string = self._fetch_data()	# grab the contents of the sensor upload
 	# if there is a response from the server
         if status_string:
-            debug('Updater.get_status.status_string(from server):', status_string)
+	    self.stats['fetched'] += 1
+	    digest = hashlib.md5(status_string).digest()
+	    if digest == self.digest:
+		# same bytes as last time, so the same Status as last time
+		self.stats['unchanged'] += 1
+		return False
+	    self.digest = digest
+	    self.stats['parsed'] += 1
+            debug('Updater.get_status.status_string(from server): %s', status_string)
 	    # parse the response
-            status = parser.get_status(status_string)
+            status = StatusParser().get_status(status_string)
+	    status._set_time_fetched(self.time_fetched)
 	    # and update the values with the resulting Status object
-            self.last_status = self.status
-            self.status = status
-            debug('Updater.get_status.status(parsed):', str(self.status))
-	debug('Updater.get_status: done')
-
-    def _fetch_data(self, count=0):
+	    with self._lock:
+		self.last_status = self.status
+		self.status = status
+		# Test if the Status is a newer status than the last one fetched, check() announces it.
+		if self.is_new_status():
+		    self._changed = True
+		# Every sensor that flipped is an event, whatever change_detection says.
+		if self.last_status:
+		    self._events.extend(self.status.changes(self.last_status))
+                debug('Updater.get_status: self.status: %r\nself.last_status: %r', self.status, self.last_status)
+            debug('Updater.get_status.status(parsed): %s', self.status)
+	    debug('Updater.get_status: done')
+	    return True
+	debug('Updater.get_status: nothing new')
+	return False
+
+    def _fetch_data(self):
 	''' Grab the sensor data from the sensor upload url
-	@param	count		the number of levels of recursion
-	@return			status data string if available otherwise return None
-	'''
-	if count >= 3:
-	    raise StatusPluginException('''Can't connect to %s''' % self.source)
-	debug('Updater._fetch_data.source:', self.source)
+	Retries are left to self.retry and a source that keeps failing is left alone by self.breaker.
+	@return			status data string if available otherwise return None (also when the
+				server says the data is not modified since the last fetch)
+	'''
+	if not self.breaker.allow():
+	    # the source has been failing, don't hammer it until it's time to probe
+	    debug('Updater._fetch_data: circuit open, skipping fetch')
+	    self.stats['short_circuited'] += 1
+	    return None
+	debug('Updater._fetch_data.source: %s', self.source)
 	try:
-	    # fetch raw data from the server
-	    request = urllib2.Request(url=self.source)
-            reply = urllib2.urlopen(request, timeout=self.timeout)
-	    debug('Updater._fetch_data.reply:', str(reply))
-	    # if the http code indicates a successful request extract the data from the reply
-            if reply.getcode() == 200:
-	        debug('Updater._fetch_data: reply is good')
-                return reply.read()
-	except urllib2.URLError as e:
-	    warn('Updater._fetch_data: ',e)
-	    if hasattr(e, 'reason') and str(e.reason).strip() == 'timed out':
-	        time.sleep(3)
-		return self._fetch_data(count+1)
+	    reply = self.retry.call(self._request, FetchExceptions)
+	except FetchExceptions as e:
+	    warn('Updater._fetch_data: giving up: %r', e)
+	    self.stats['failed'] += 1
+	    self.breaker.failure()
+	    return None
+	self.breaker.success()
+	# the source answered so whatever status we hold is current as of now
+	self.time_fetched = int(time.time())
+	if self.status:
+	    self.status._set_time_fetched(self.time_fetched)
+	# if the http code indicates a successful request extract the data from the reply
+        if reply.status == 200:
+	    debug('Updater._fetch_data: reply is good')
+	    # remember the validators so the next poll can be conditional
+	    self.etag = reply.getheader('ETag')
+	    self.last_modified = reply.getheader('Last-Modified')
+            return reply.body
+	elif reply.status == 304:
+	    # nothing changed since the last full reply
+	    debug('Updater._fetch_data: not modified')
+	    self.stats['not_modified'] += 1
+	else:
+	    warn('Updater._fetch_data: HTTP %s', reply.status)
 	return None
 
+    def _request(self):
+	''' Make one request for the sensor data over the pooled keep-alive connection.
+	@return			connection.Response
+	@raise	StatusPluginException	if the server had an error, so it gets retried.
+	'''
+        reply = self.pool.get(self.source, self._conditional_headers())
+	debug('Updater._request.reply: %s', reply.status)
+	if reply.status >= 500:
+	    raise StatusPluginException('HTTP %d from %s' % (reply.status, self.source))
+	return reply
+
+    def _conditional_headers(self):
+	''' Build the validator headers for a conditional request.
+	@return			dict of If-None-Match/If-Modified-Since headers (empty on the first fetch)
+	'''
+	headers = {}
+	if self.etag:
+	    headers['If-None-Match'] = self.etag
+	if self.last_modified:
+	    headers['If-Modified-Since'] = self.last_modified
+	return headers
+
     def is_new_status(self):
         ''' Test if the most recently grabbed status is newer than the last one 
 	@return			True if status has changed or False if it has not.
@@ -114,9 +267,9 @@ class Updater:
 	# If both the current and previous statuses exist check if the current is different from the pervious
         if self.status and self.last_status and self.status.time_changed and self.last_status.time_changed:
             debug('Updater.is_new_status: both statuses exist')
-            if self.status >= self.last_status and self.status != self.last_status:
+            if self.status >= self.last_status and self.status.diff(self.last_status, self.change_mask):
         	# if the new status is newer than or the same age as the last status found
-	        # and if they are not equal there has been a status change it's new
+	        # and the sensors we watch differ there has been a status change it's new
                 debug('Updater.is_new_status: new status')
                 return True
             elif self._first_run:
@@ -130,8 +283,17 @@ class Updater:
         return False
 
 
-class Sensor:
-    ''' Stores the state of a sensor '''
+class Sensor(object):
+    ''' Stores the state of a sensor.
+    Sensors are immutable (and so safe to share), with_boolean() returns a new one in another state.
+    '''
+    __slots__ = ('id', 'label', 'boolean')
+
+    # valid values for Sensor.with_boolean() and what they mean
+    _booleans = {'on':True, True:True, 'true':True, 'off':False, False:False, 'false':False, None:None}
+    # how each state reads to humans
+    _boolstrs = {True:'on', False:'off', None:'unknown'}
+
     def __init__(self, id, label, boolean=None):
 	'''
 	@param	id	String referencing a key in the sensor data
@@ -139,30 +301,22 @@ class Sensor:
 	@param	boolean	valid values are: 'on', 'true', True, 'off', False, 'false', None
 	'''
 	# The label used in the raw sensor data for the field
-        self.id = id
+        object.__setattr__(self, 'id', id)
 	# The string for humans to see as the label
-	self.label = label
-	# The on/off state of the sensor as reported (on==True, off==False)
-	self.boolean = None
-	# sanely set self.boolean with the value passed to us
-        self.set_boolean(boolean)
-
-    def set(self, value):
-        ''' Set the state of the sensor appropriately 
-	Sets self.boolean via self.set_boolean()
-	@param	value	Value to set self.boolean to. see Sensor.set_boolean() for valid values
-	'''
-        self.set_boolean(value)
-
-    def set_boolean(self, value):
-        ''' Set self.boolean with a bool version of the sensor state
-	Sets self.boolean via self.set_boolean()
-        @param	value	Value to set self.boolean to. Valid values are: 
+	object.__setattr__(self, 'label', label)
+	# The on/off state of the sensor as reported (on==True, off==False), mapped sanely from the value passed to us
+	object.__setattr__(self, 'boolean', self._booleans[boolean])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Sensor is immutable, use with_boolean()')
+
+    def with_boolean(self, value):
+        ''' Return a copy of this sensor in another state
+        @param	value	Value for the new Sensor.boolean. Valid values are: 
 			'on', 'true', True, 'off', False, 'false', or None.
 			None is for unset or indeterminate state.
         '''
-	# map the supplied value to True, False, or None
-        self.boolean = {'on':True, True:True, 'true':True, 'off':False, False:False, 'false':False, None:None}[value]
+        return Sensor(self.id, self.label, value)
 
     @property
     def boolstr(self):
@@ -170,9 +324,9 @@ class Sensor:
 	@return		A string representation of Sensor.boolean. True == 'on', False == 'off', None == 'unknown'
 	'''
 	# For future reference: return {True:'on', 'true':'on', False:'off', 'false':'off', None:'unknown'}[self.boolean]
-        return {True:'on', False:'off', None:'unknown'}[self.boolean]
+        return self._boolstrs[self.boolean]
 
-    def __dict__(self):
+    def as_dict(self):
         ''' Return a dict representation of the Sensor object
 	@return		{'id': self.id, 'label': self.label, 'boolean': self.boolean}
 	'''
@@ -187,11 +341,97 @@ class Sensor:
 	'''
         return self.boolean == other.boolean
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.boolean)
+
+
+class ChangeEvent(collections.namedtuple('ChangeEvent', ['key', 'label', 'old', 'new'])):
+    ''' One sensor changing state between two consecutive statuses.
+    key is the sensor's key in state.SENSORS, old and new are its Sensor.boolean values.
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+	return '%s: %s -> %s' % (self.label or self.key, Sensor._boolstrs[self.old], Sensor._boolstrs[self.new])
+
+
+# name -> callable(Status) returning that format of the status message, see register_format()
+message_formats = {}
+
+def register_format(name):
+    ''' Decorator registering a renderer for a format of the status message.
+    @param	name	Key of the format in Status.message.
+    '''
+    def register(renderer):
+        message_formats[name] = renderer
+        return renderer
+    return register
+
+@register_format('raw')
+def raw_message(status):
+    ''' The source text verbatim '''
+    return status.source_string
+
+@register_format('human')
+def human_message(status):
+    ''' A more verbose readout of the status of each sensor '''
+    return status._sensor_status()
+
+@register_format('default')
+def default_message(status):
+    ''' The more traditional format of status, None if the lights state is unknown '''
+    lights = status.info.get('lights')
+    if lights is None or lights.boolean is None:
+        return None
+    if status.time_changed:
+        date = status.time_changed.strftime('%I:%M%p %A %d %b')
+    else:
+        date = 'date unknown'
+    return include.default_msg % ({True:'open', False:'closed'}[lights.boolean], date)
+
+@register_format('changed')
+def changed_message(status):
+    ''' The time the status changed as a unix timestamp string '''
+    if status.time_changed:
+        return status.time_changed.strftime('%s')
+    return None
+
+
+class Message(dict):
+    ''' dict of the formats of a status message.
+    Each format is rendered by its renderer in message_formats the first time it is read and
+    remembered after that, so parsing a status costs nothing for formats nobody reads.
+    '''
+
+    def __init__(self, status):
+	'''
+	@param	status	The Status to render.
+	'''
+        dict.__init__(self, time_fetched=0)
+        self.status = status
+
+    def __missing__(self, key):
+        if key not in message_formats:
+            raise KeyError(key)
+        value = self[key] = message_formats[key](self.status)
+        return value
 
-class Status:
+    def get(self, key, default=None):
+        ''' Return a format, or default if there is no such format. Errors rendering it are raised. '''
+        if key not in self and key not in message_formats:
+            return default
+        return self[key]
+
+
+class Status(object):
     ''' Status class
     For the storage and comparison of status states.
+    Each parse makes a new Status with its own sensors, nothing but the message cache changes after that.
     '''
+    __slots__ = ('time_changed', 'message', 'info', 'sensors', 'source_string', 'state')
 
     state_field = 'lights' # key to retrive the overal state (open/closed) from Status.info
 
@@ -202,81 +442,76 @@ class Status:
 	@param	source_string	The raw sensor data string.
 	@param	info		General info about the sensor status including open/closed state.
 	'''
-        debug('Status(sensors)', *([str(x) for x in sensors]))
         self.time_changed = time_changed
-	# Set a bare message dict
-	self.message = {'raw':None, 'human':None, 'default':None, 'changed':None, 'time_fetched':0}
+	# The formats of the status message, each rendered the first time it is read
+	self.message = Message(self)
         self.info = info
         self.sensors = sensors
         self.source_string = source_string
-	# Populate the messages in the message.
-        self._set_message()
-        debug('Status.sensors', ', '.join(['%s: %s' % (k, str(v)) for k,v in self.sensors.items()]))
+	# All the sensor states packed into an int (see state.py)
+	self.state = state.encode(dict((k, v.boolean) for d in (sensors, info) for k, v in d.iteritems()))
+	if debug_enabled():
+	    debug('Status.sensors %s', ', '.join(['%s: %s' % (k, str(v)) for k,v in self.sensors.items()]))
 
     def _sensor_status(self):
         ''' Return a human friendly string representing the status of all the sensors '''
         return ', '.join(['%s is %s' % (k.label, k.boolstr) for k in self.sensors.values() if k.label])
 
-    def _set_message(self):
-        ''' Set all formats of the status messages
-	Sets values for 'raw', 'human', 'default', 'changed' in Status.message.
-	'''
-	self.message['changed'] = self.time_changed.strftime('%s')
-        self._set_raw_message()
-        self._set_human_message()
-        self._set_default_message()
-
-    def _set_default_message(self):
-        ''' Set the default message with the more traditional format of status 
-	Sets value for 'default' in Status.message.
-	'''
-        if self.time_changed:
-            date = self.time_changed.strftime('%I:%M%p %A %d %b')
-        else:
-            date = 'date unknown'
-        self.message['default'] = include.default_msg % ({True:'open', False:'closed'}[self.info.get('lights').boolean], date)
-
-    def _set_human_message(self):
-        ''' Set the human friendly message to a more verbose readout of the status.
-	Sets value for 'human' in Status.message.
-	'''
-        self.message['human'] = self._sensor_status()
-
-    def _set_raw_message(self):
-        ''' Set the 'raw' message to be the source text.
-	Sets value for 'raw' in Status.message.
+    def _set_time_fetched(self, timestamp=None):
+	''' Set the time this status was last fetched (or confirmed unchanged by the source)
+	@param	timestamp	Unix timestamp, defaults to now.
 	'''
-        self.message['raw'] = self.source_string
-
-    def _set_time_fetched(self):
-	''' Set the time this object was created (which should be the time it was fetched) '''
-	self.message['time_fetched'] = int(time.mktime(time.gmtime()) or 0)
+	self.message['time_fetched'] = int(timestamp or time.time())
 
-    def __dict__(self):
+    def as_dict(self):
         ''' Return a representation of this instance as a dict.
 	@return		A representation of this instance as a dict with the keys of: 
 			'time_changed', 'message', 'sensors', 'info', and 'source_string'.
 	'''
         return {'time_changed': self.time_changed, 
 		'message': self.message, 
-		'sensors': dict((k, v.__dict__) for k,v in self.sensors.items()), 
+		'sensors': dict((k, v.as_dict()) for k,v in self.sensors.items()), 
 		'info': self.info,
 		'source_string':self.source_string}
 
     def __str__(self):
-	 return '{%s: %s, %s: %s, %s: %s, %s: %s, %s: %s}' % ('time_changed', self.time_changed, 'message', self.message, 'sensors', dict((k, v.__dict__) for k,v in self.sensors.items()), 'info', self.info, 'source_string', self.source_string)
+	 return '{%s: %s, %s: %s, %s: %s, %s: %s, %s: %s}' % ('time_changed', self.time_changed, 'message', self.message, 'sensors', dict((k, v.as_dict()) for k,v in self.sensors.items()), 'info', self.info, 'source_string', self.source_string)
 
     def __eq__(self, other):
         ''' Test if the state of this status is the same value as the other state.
 	@param	other	Another instance of Status.
-	@return		True if Status.info.get(Status.state_field) is the same for both instances, otherwise False.
+	@return		True if every sensor is in the same state in both instances, otherwise False.
+	'''
+        return self.state == other.state
+
+    def __hash__(self):
+	''' Hash the same state the same way, see __eq__ '''
+        return hash(self.state)
+
+    def diff(self, other, bits=state.ALL_MASK):
+	''' Return the keys of the sensors that differ between this status and another.
+	@param	other	Another instance of Status.
+	@param	bits	Mask of the sensors to compare (see state.mask()).
+	@return		List of sensor keys in state.SENSORS order.
+	'''
+	return state.diff(other.state, self.state, bits)
+
+    def sensor(self, key):
+	''' Return the Sensor for a key from either the body sensors or the info (subject) sensors '''
+	return self.sensors.get(key) or self.info.get(key)
+
+    def changes(self, previous):
+	''' Return a ChangeEvent for every sensor that changed since the previous status.
+	@param	previous	The Status before this one.
+	@return			List of ChangeEvent in state.SENSORS order.
 	'''
-        return self.info.get(self.state_field) == other.info.get(self.state_field)
+	return [ChangeEvent(key, self.sensor(key).label, state.value(previous.state, key), state.value(self.state, key))
+		for key in self.diff(previous)]
 
     def __ne__(self, other):
 	''' Test if the state of this status is a different value from the other state
 	@param	other	Another instance of Status.
-	@return         False if Status.info.get(Status.state_field) is the same for both instances, otherwise True.
+	@return         False if every sensor is in the same state in both instances, otherwise True.
 	'''
         return not self.__eq__(other)
 
@@ -338,10 +573,19 @@ class StatusParser:
     _field_sep = ";"
     # Key value seperator (for items within a field).
     _key_val_sep = "="
-    # dict of label->Sensor's to find in the 'body' portion of the status string
+    # dict of label->Sensor's to find in the 'body' portion of the status string (all unknown, copied per parse)
     _body_sensors = {'gpio4': Sensor('GPIO4', None, None), 'gpio5': Sensor('GPIO5', None, None), 'fa3': Sensor('hall_light_on', 'hall light'), 'fa4': Sensor('main_light_on', 'main room light'), 'fa5': Sensor('work_light_on','work room light')}
-    # dict of label->Sensor's to find in the 'subject' portion of the status string
+    # dict of label->Sensor's to find in the 'subject' portion of the status string (all unknown, copied per parse)
     _subject_sensors = {'lights': Sensor('any_lights_on', 'one or more lights')}
+    # key=value lines of the upload, surrounding whitespace left out of both groups (compiled once)
+    _line_re = re.compile(r'^[^\S\n]*([^=\n]*?)[^\S\n]*=[^\S\n]*(.*?)[^\S\n]*$', re.M)
+    # key=value fields of the 'body' line for known sensors with accepted values (compiled once)
+    _body_field_re = re.compile(r'(?:^|;)\s*(%s)=(true|false)\s*(?=;|$)' % '|'.join(_body_sensors), re.I)
+    # values accepted for 'subject' sensors
+    _subject_values = frozenset(('true', 'false', 'on', 'off'))
+    # 'date' strings already parsed, keyed by (date string, year)
+    _date_cache = {}
+    _date_cache_size = 1024
 
     def __init__(self, status_string=None):
 	'''
@@ -349,8 +593,10 @@ class StatusParser:
 	'''
 	# All the values collected from the status_string.
 	self.collected_values = {}
-	# dict of label->Sensor's to stash the values found
-	self.sensor_info = self._body_sensors
+	# dict of label->Sensor's to stash the values found in the 'body'
+	self.sensor_info = dict(self._body_sensors)
+	# dict of label->Sensor's to stash the values found in the 'subject'
+	self.subject_info = dict(self._subject_sensors)
 	# The value of the 'date' field as a datetime object
 	self.last_changed_date = None
 	# the raw status string from the sensor status upload
@@ -363,7 +609,7 @@ class StatusParser:
 	@param	sensor_info	dict of label->Sensor's to stash the value in. Defaults to self.sensor_info.
 	'''
         sensor_info = sensor_info or self.sensor_info
-	sensor_info[name].set(value)
+	sensor_info[name] = sensor_info[name].with_boolean(value)
 
     def _split_dict(self, string):
         ''' Split a string formated as key-value pairs into a dict.
@@ -393,7 +639,7 @@ class StatusParser:
 	@param	string	String representing an item in the 'body' field of the sensor status upload.
 	'''
         sub = string.split(self._key_val_sep, 1)
-        debug('StatusParser._parse_body.sub', repr(sub))
+        debug('StatusParser._parse_body.sub %r', sub)
 	if len(sub) == 2 and sub[0].lower() in self._body_sensors and sub[1].lower() in ('true', 'false'):
 	    self.set_sensor(sub[0].lower(), sub[1].lower())
 
@@ -406,33 +652,77 @@ class StatusParser:
         if len(body_string) >= 1:
 	    for field in self._split_list(body_string):
 		self._parse_body_field(field)
-                debug('body field:',field)
+                debug('body field: %s', field)
 
     def _parse_subject(self, subject_string):
         ''' Parse the 'subject' field.
-        Sets self.sensor_info value via self.set_sensor().
+        Sets self.subject_info value via self.set_sensor().
 	@param	subject_string	String representation of the key-value pair in the 'subject' field of the sensor status upload.
 	'''
         sub = self._split_key_val(subject_string)
 	if len(sub) == 2 and sub[0].lower() and sub[1].lower() in ('true', 'false', 'on', 'off'):
-	    self.set_sensor(sub[0].lower(), sub[1].lower(), self._subject_sensors)
+	    self.set_sensor(sub[0].lower(), sub[1].lower(), self.subject_info)
 
     def _parse_date(self, date_string):
         ''' Parse the 'date' field.
 	Sets self.last_changed_date.
 	@param	date_string	String representation of the date in the 'date' field of the sensor status upload.
 	'''
-        debug('StatusParser._parse_date.date_string:', date_string)
+        debug('StatusParser._parse_date.date_string: %s', date_string)
+	# strptime is by far the slowest part of parsing, and the sensor repeats itself a lot
+	key = (date_string, datetime.datetime.now().year)
+	if key in self._date_cache:
+	    self.last_changed_date = self._date_cache[key]
+	    return
         try:
 	    # turn the date string into a datetime instance and add a year field because it is missing from the data from the sensor
-            self.last_changed_date = datetime.datetime.strptime(date_string, self._date_format).replace(year=datetime.datetime.now().year)
-            debug('StatusParser._parse_date.last_changed_date:', repr(self.last_changed_date))
+            self.last_changed_date = datetime.datetime.strptime(date_string, self._date_format).replace(year=key[1])
+            debug('StatusParser._parse_date.last_changed_date: %r', self.last_changed_date)
 	except Exception as e:
-            error(e)
+            error('StatusParser._parse_date: %r', e)
 	    self.last_changed_date = None
+	    return
+	if len(self._date_cache) >= self._date_cache_size:
+	    self._date_cache.clear()
+	self._date_cache[key] = self.last_changed_date
 
     def parse_status(self, status_string=None):
-        ''' Parse the whole status message from the sensor status upload.
+        ''' Parse the whole status message from the sensor status upload in a single pass.
+	Gives the same results as parse_status_split() using the regular expressions compiled above.
+	@param	status_string	The raw contents of the sensor status upload. Defaults to self.status_string.
+	'''
+        if status_string:
+	    # If status_string was passed use it instead of self.status_string.
+            self.status_string = status_string
+	for match in self._line_re.finditer(self.status_string):
+	    key, val = match.groups()
+	    parser = self._line_parsers.get(key.lower())
+	    if parser:
+		parser(self, val)
+
+    def _parse_subject_fast(self, subject_string):
+        ''' Parse the 'subject' field for parse_status(), see _parse_subject(). '''
+	match = self._line_re.match(subject_string)
+	if match:
+	    key, val = match.groups()
+	    if key and val.lower() in self._subject_values:
+		self.set_sensor(key.lower(), val.lower(), self.subject_info)
+
+    def _parse_body_fast(self, body_string):
+        ''' Parse the 'body' field for parse_status(), see _parse_body(). '''
+	# only fields for known sensors with accepted values match at all
+	sensors = self.sensor_info
+	for match in self._body_field_re.finditer(body_string):
+	    key, val = match.groups()
+	    key = key.lower()
+	    sensors[key] = sensors[key].with_boolean(val.lower())
+
+    # line key -> parser for its value, used by parse_status()
+    _line_parsers = {'date': _parse_date, 'subject': _parse_subject_fast, 'body': _parse_body_fast}
+
+    def parse_status_split(self, status_string=None):
+        ''' Parse the whole status message from the sensor status upload by splitting it up.
+	This is the original parser, kept as the reference parse_status() is tested and benchmarked against.
 	@param	status_string	The raw contents of the sensor status upload. Defaults to self.status_string.
 	'''
         if status_string:
@@ -463,8 +753,19 @@ class StatusParser:
 	'''
 	# Parse the input string and set self.sensor_info with the result
         self.parse_status(status_string)
-        debug('StatusParser.get_status,sensor_info', str(self.sensor_info))
+        debug('StatusParser.get_status,sensor_info %s', self.sensor_info)
 	# Populate a Status instance and return it.
-        return Status(self.last_changed_date, self.sensor_info, self.status_string, self._subject_sensors)
+        return Status(self.last_changed_date, self.sensor_info, self.status_string, self.subject_info)
+
+def sensor_label(key):
+    ''' Return the label of the sensor with a key in state.SENSORS (None if it has none) '''
+    sensor = StatusParser._body_sensors.get(key) or StatusParser._subject_sensors.get(key)
+    return sensor and sensor.label
+
+def unix_time(status):
+    ''' Return the time a Status changed in unix seconds, 0 if it has no time '''
+    if status.time_changed:
+        return time.mktime(status.time_changed.timetuple())
+    return 0
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: